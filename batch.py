@@ -0,0 +1,223 @@
+from __future__ import annotations
+import csv, fnmatch, glob, multiprocessing, os, sys, time
+from functools import partial
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from cache import CFGCache, DEFAULT_MAX_BYTES
+from cfg import CFG, build_from_source
+from profiler import Profiler, stage
+
+
+class FileResult(NamedTuple):
+    path: str
+    ok: bool
+    seconds: float
+    blocks: int = 0
+    error: Optional[str] = None
+    cached: bool = False
+    profile: Optional[Dict[str, Any]] = None
+    metrics: Optional[List[Tuple[str, Dict[str, int]]]] = None
+
+
+class BatchStats:
+
+    def __init__(self, profile: bool = False):
+        self.profiler: Optional[Profiler] = Profiler() if profile else None
+        self.files: int = 0
+        self.failed: int = 0
+        self.blocks: int = 0
+        self.cache_hits: int = 0
+        self.cache_misses: int = 0
+        self.build_seconds: float = 0.0
+        self.started: float = time.perf_counter()
+        self.elapsed: float = 0.0
+
+    def add(self, result: FileResult) -> None:
+        self.files += 1
+        self.build_seconds += result.seconds
+        if self.profiler is not None and result.profile is not None:
+            self.profiler.merge(result.profile)
+        if result.ok:
+            self.blocks += result.blocks
+            if result.cached:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+        else:
+            self.failed += 1
+
+    def finish(self) -> None:
+        self.elapsed = time.perf_counter() - self.started
+
+    def summary(self, cache: bool = False) -> str:
+        elapsed = self.elapsed or 1e-9
+        summary = '{} files ({} failed), {} blocks in {:.2f}s: {:.1f} files/s, {:.1f} blocks/s, {:.2f} ms/file of worker time'.format(
+            self.files, self.failed, self.blocks, self.elapsed, self.files / elapsed, self.blocks / elapsed,
+            1000 * self.build_seconds / self.files if self.files else 0.0)
+        if cache:
+            summary += ', cache: {} hits, {} misses'.format(self.cache_hits, self.cache_misses)
+        return summary
+
+
+class MetricsWriter:
+    # Streams one row per function (file, function and CFG.metric_names) as results come in. Paths ending in
+    # .parquet are written with pyarrow in row groups of batch_rows rows, anything else as CSV.
+
+    columns: Tuple[str, ...] = ('file', 'function') + CFG.metric_names
+
+    def __init__(self, filepath: str, batch_rows: int = 65536):
+        self.filepath: str = filepath
+        self.batch_rows: int = batch_rows
+        self.rows: int = 0
+        self.parquet: bool = filepath.endswith('.parquet')
+        if self.parquet:
+            import pyarrow, pyarrow.parquet  # optional, only needed for parquet output
+            self.schema = pyarrow.schema([(c, pyarrow.string() if c in ('file', 'function') else pyarrow.int64()) for c in self.columns])
+            self.writer = pyarrow.parquet.ParquetWriter(filepath, self.schema)
+            self.pending: Dict[str, List] = {c: [] for c in self.columns}
+        else:
+            self.file = open(filepath, 'w', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.columns)
+
+    def write(self, path: str, metrics: Iterable[Tuple[str, Dict[str, int]]]) -> None:
+        for function, values in metrics:
+            row = (path, function) + tuple(values[name] for name in CFG.metric_names)
+            self.rows += 1
+            if not self.parquet:
+                self.writer.writerow(row)
+                continue
+            for column, value in zip(self.columns, row):
+                self.pending[column].append(value)
+            if len(self.pending['file']) >= self.batch_rows:
+                self.flush()
+
+    def flush(self) -> None:
+        if self.parquet and self.pending['file']:
+            import pyarrow
+            self.writer.write_table(pyarrow.table(self.pending, schema=self.schema))
+            self.pending = {c: [] for c in self.columns}
+
+    def close(self) -> None:
+        if self.parquet:
+            self.flush()
+            self.writer.close()
+        else:
+            self.file.close()
+
+
+def has_magic(path: str) -> bool:
+    return any(c in path for c in '*?[')
+
+
+def iter_sources(paths: Iterable[str], pattern: str = '*.py') -> Iterator[str]:
+    # Directories are walked recursively, glob patterns are expanded and plain paths are passed through.
+    # Every file is yielded once, in a deterministic order.
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = []
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                candidates.extend(os.path.join(root, name) for name in sorted(files) if fnmatch.fnmatch(name, pattern))
+        elif has_magic(path):
+            candidates = [match for match in sorted(glob.glob(path, recursive=True)) if os.path.isfile(match)]
+        else:
+            candidates = [path]
+        for candidate in candidates:
+            if candidate not in seen:
+                seen.add(candidate)
+                yield candidate
+
+
+def output_path(output_dir: str, path: str) -> str:
+    rel = os.path.relpath(path)
+    if rel.startswith(os.pardir):
+        rel = os.path.abspath(path).lstrip(os.sep)
+    return os.path.join(output_dir, os.path.splitext(rel)[0])
+
+
+def build_cached(source: str, path: str, cache: Optional[CFGCache], reformat: bool = False, strict: bool = False,
+                 profiler: Optional[Profiler] = None, jobs: int = 1) -> Tuple[CFG, bool]:
+    # jobs > 1 builds the function CFGs of the file in parallel; pool workers cannot start pools of their own,
+    # so batch mode leaves it at 1
+    if cache is None:
+        return build_from_source(source, path, reformat, strict, profiler, jobs), False
+    with stage(profiler, 'cache'):
+        return cache.get_or_build(source, path, partial(build_from_source, source, path, reformat, strict, profiler, jobs),
+                                  'reformat' if reformat else 'original', 'strict' if strict else 'lenient')
+
+
+def build_file(path: str, output_dir: Optional[str] = None, fmt: str = 'pdf', cache_dir: Optional[str] = None,
+               cache_size: int = DEFAULT_MAX_BYTES, emit: str = 'graph', reformat: bool = False,
+               strict: bool = False, profile: bool = False, metrics: bool = False, simplify: Optional[str] = None) -> FileResult:
+    # with profile, the stages of this file are returned in the result and merged by the parent process;
+    # simplify is None, 'coalesce' or 'compact' (see CFG.coalesce)
+    start = time.perf_counter()
+    profiler = Profiler() if profile else None
+    try:
+        with stage(profiler, 'file', path=path):
+            with open(path, 'r') as f:
+                source = f.read()
+            cfg, cached = build_cached(source, path, CFGCache(cache_dir, cache_size) if cache_dir else None, reformat, strict, profiler)
+            if simplify is not None:
+                with stage(profiler, 'simplify'):
+                    cfg.coalesce(compact=simplify == 'compact')
+            if output_dir is not None:
+                target = output_path(output_dir, path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # the pool already renders files in parallel, so sharded output renders one function at a time
+                cfg.save(target, emit, fmt, show=False, profiler=profiler, jobs=1)
+            # function CFGs are built on first access, so counting and metrics can still fail on one of them
+            if profiler is not None:
+                profiler.count(cfg, path + ':')
+            rows = None
+            if metrics:
+                with stage(profiler, 'metrics'):
+                    # function names relative to the module, whose own row is '<module>'
+                    rows = [(name[len(cfg.name) + 1:] or '<module>', values) for name, values in cfg.function_metrics()]
+    except Exception as e:
+        return FileResult(path, False, time.perf_counter() - start, error='{}: {}'.format(type(e).__name__, e),
+                          profile=profiler.to_dict() if profiler is not None else None)
+    return FileResult(path, True, time.perf_counter() - start, len(cfg.live_blocks()), cached=cached,
+                      profile=profiler.to_dict() if profiler is not None else None, metrics=rows)
+
+
+def report(stats: BatchStats, result: FileResult, metrics: Optional[MetricsWriter] = None) -> None:
+    stats.add(result)
+    if metrics is not None and result.metrics is not None:
+        metrics.write(result.path, result.metrics)
+    if not result.ok:
+        print('{}: {}'.format(result.path, result.error), file=sys.stderr)
+
+
+def run_batch(paths: Iterable[str], jobs: Optional[int] = None, output_dir: Optional[str] = None, fmt: str = 'pdf',
+              pattern: str = '*.py', chunksize: int = 8, cache_dir: Optional[str] = None,
+              cache_size: int = DEFAULT_MAX_BYTES, emit: str = 'graph', reformat: bool = False,
+              strict: bool = False, profile: bool = False, metrics_path: Optional[str] = None,
+              simplify: Optional[str] = None) -> BatchStats:
+    # with metrics_path, the metrics of every function are written there (CSV or .parquet)
+    files: List[str] = list(iter_sources(paths, pattern))
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(files) or 1))
+    worker = partial(build_file, output_dir=output_dir, fmt=fmt, cache_dir=cache_dir, cache_size=cache_size,
+                     emit=emit, reformat=reformat, strict=strict, profile=profile, metrics=metrics_path is not None,
+                     simplify=simplify)
+    stats = BatchStats(profile)
+    metrics = MetricsWriter(metrics_path) if metrics_path is not None else None
+
+    try:
+        if jobs == 1:
+            for result in map(worker, files):
+                report(stats, result, metrics)
+        else:
+            with multiprocessing.Pool(jobs) as pool:
+                for result in pool.imap_unordered(worker, files, chunksize):
+                    report(stats, result, metrics)
+    finally:
+        if metrics is not None:
+            metrics.close()
+    if cache_dir:
+        # workers only store entries; the size cap is enforced once for the whole run
+        CFGCache(cache_dir, cache_size).trim()
+    stats.finish()
+    return stats
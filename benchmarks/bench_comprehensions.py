@@ -0,0 +1,111 @@
+"""Build time of comprehension-dense modules with comprehensions desugared into For/If trees against direct emission.
+
+    python3 benchmarks/bench_comprehensions.py [-n REPEAT] [sizes...]
+"""
+from __future__ import annotations
+import argparse, ast, os, sys, time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cfg import CFG, CFGVisitor, split_lines
+import synth
+
+
+class DesugaringVisitor(CFGVisitor):
+    # the old visitor: every comprehension becomes a tree of For and If statements that is visited like source code,
+    # after the calls in its element were recorded in the block before the loops; nested comprehensions are not
+    # expanded
+
+    def pop_comprehension(self, node: ast.AST) -> Optional[Tuple[Optional[str], ast.AST]]:
+        if self.comprehensions and self.comprehensions[-1][1] is node:
+            return self.comprehensions.pop()
+        return None
+
+    def desugar(self, generators: List[ast.comprehension], element: ast.stmt) -> List[ast.stmt]:
+        if not generators:
+            return [element]
+        generator = generators[-1]
+        body = self.desugar(generators[:-1], element)
+        if generator.ifs:
+            body = [ast.If(test=self.combine_conditions(generator.ifs), body=body, orelse=[])]
+        return [ast.For(target=generator.target, iter=generator.iter, body=body, orelse=[])]
+
+    def visit_ListComp(self, node):
+        comprehension = self.pop_comprehension(node)
+        if comprehension:
+            self.generic_visit(node.elt)
+            if comprehension[0]:
+                element = ast.Expr(value=ast.Call(func=ast.Attribute(value=ast.Name(id=comprehension[0], ctx=ast.Load()), attr='append', ctx=ast.Load()), args=[node.elt], keywords=[]))
+            else:
+                element = ast.Expr(value=node.elt)
+            self.generic_visit(ast.Module(self.desugar(node.generators, element)))
+
+    def visit_SetComp(self, node):
+        comprehension = self.pop_comprehension(node)
+        if comprehension:
+            self.generic_visit(node.elt)
+            element = ast.Expr(value=ast.Call(func=ast.Attribute(value=ast.Name(id=comprehension[0], ctx=ast.Load()), attr='add', ctx=ast.Load()), args=[node.elt], keywords=[]))
+            self.generic_visit(ast.Module(self.desugar(node.generators, element)))
+
+    def visit_DictComp(self, node):
+        comprehension = self.pop_comprehension(node)
+        if comprehension:
+            element = ast.Assign(targets=[ast.Subscript(value=ast.Name(id=comprehension[0], ctx=ast.Load()), slice=node.key, ctx=ast.Store())], value=node.value)
+            self.generic_visit(ast.Module(self.desugar(node.generators, element)))
+
+    def visit_GeneratorExp(self, node):
+        comprehension = self.pop_comprehension(node)
+        if comprehension:
+            self.generic_visit(node.elt)
+            self.generic_visit(ast.FunctionDef(name='__' + comprehension[0] + 'Generator__',
+                args=ast.arguments(args=[], vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[]),
+                body=self.desugar(node.generators, ast.Expr(value=ast.Yield(value=node.elt))), decorator_list=[], returns=None))
+
+
+def build(visitor: Callable[[], CFGVisitor], tree: ast.Module, lines: List[str]) -> CFG:
+    cfg = visitor().build('comps', tree, lines)
+    # every function graph, nested ones included
+    pending = [cfg]
+    while pending:
+        curr = pending.pop()
+        pending.extend(curr.func_calls.values())
+    return cfg
+
+
+def without_calls(data: Dict[str, Any]) -> Dict[str, Any]:
+    # to_dict() of a CFG without the calls of its blocks, which the old visitor recorded before the loops
+    return dict(data, blocks=[dict(block, calls=[]) for block in data['blocks']],
+                func_calls={k: without_calls(v) for k, v in data['func_calls'].items()})
+
+
+def best_of(visitor: Callable[[], CFGVisitor], tree: ast.Module, lines: List[str], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        build(visitor, tree, lines)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('sizes', nargs='*', type=int, default=[100, 1000, 10000])
+    arg_parser.add_argument('-n', '--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    print('{:>14} {:>10} {:>14} {:>14} {:>8}'.format('comprehensions', 'blocks', 'desugared', 'direct', 'speedup'))
+    for n in args.sizes:
+        source = synth.comprehensions(n)
+        tree, lines = ast.parse(source), split_lines(source)
+        cfg = build(CFGVisitor, tree, lines)
+        if without_calls(cfg.to_dict()) != without_calls(build(DesugaringVisitor, tree, lines).to_dict()):
+            sys.exit('the CFGs of comprehensions({}) differ'.format(n))
+        blocks = sum(len(graph.blocks) for graph in cfg.func_calls['comps'].func_calls.values()) + len(cfg.func_calls['comps'].blocks)
+        old = best_of(DesugaringVisitor, tree, lines, args.repeat)
+        new = best_of(CFGVisitor, tree, lines, args.repeat)
+        print('{:>14} {:>10} {:>11.2f} ms {:>11.2f} ms {:>7.2f}x'.format(n, blocks, 1000 * old, 1000 * new, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Per-file latency of the old double-parse pipeline against the single-parse one.
+
+    python3 benchmarks/bench_parse.py [-n REPEAT] [files...]
+"""
+from __future__ import annotations
+import argparse, ast, glob, os, sys, time
+from typing import Callable, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cfg import CFGVisitor, PyParser, build_from_source
+import synth
+
+
+def old_pipeline(source: str, name: str) -> None:
+    # compile for the syntax check, then tokenize, autopep8 and parse again
+    compile(source, name, 'exec')
+    parser = PyParser(source)
+    parser.removeCommentsAndDocstrings()
+    parser.formatCode()
+    CFGVisitor().build(name, ast.parse(parser.script))
+
+
+def compile_then_parse(source: str, name: str) -> None:
+    # the old syntax check in front of the new pipeline
+    compile(source, name, 'exec')
+    build_from_source(source, name)
+
+
+def single_parse(source: str, name: str) -> None:
+    build_from_source(source, name)
+
+
+def best_of(fn: Callable[[str, str], None], source: str, name: str, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(source, name)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('files', nargs='*')
+    arg_parser.add_argument('-n', '--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    corpus: List[Tuple[str, str]] = [(path, open(path).read()) for path in args.files]
+    if not corpus:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        corpus = [(path, open(path).read()) for path in sorted(glob.glob(os.path.join(root, 'examples', '*.py')))]
+        corpus += [('synthetic realistic({})'.format(n), synth.realistic(n)) for n in (20, 100)]
+
+    pipelines = [('old', old_pipeline), ('compile+parse', compile_then_parse), ('single parse', single_parse)]
+    print('{:<40} {:>7} '.format('file', 'lines') + ' '.join('{:>14}'.format(name) for name, _ in pipelines) + ' {:>8}'.format('speedup'))
+    totals = [0.0] * len(pipelines)
+    for name, source in corpus:
+        times = [best_of(fn, source, name, args.repeat) for _, fn in pipelines]
+        totals = [t + x for t, x in zip(totals, times)]
+        print('{:<40} {:>7} '.format(os.path.basename(name)[:40], source.count('\n') + 1)
+              + ' '.join('{:>11.2f} ms'.format(1000 * t) for t in times) + ' {:>7.1f}x'.format(times[0] / times[-1]))
+    print('{:<40} {:>7} '.format('total', '') + ' '.join('{:>11.2f} ms'.format(1000 * t) for t in totals)
+          + ' {:>7.1f}x'.format(totals[0] / totals[-1]))
+
+
+if __name__ == '__main__':
+    main()
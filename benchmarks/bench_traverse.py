@@ -0,0 +1,34 @@
+"""Stress test of the graph walks (remove_empty_blocks during the build, CFG._traverse when writing DOT) on huge functions.
+
+    python3 benchmarks/bench_traverse.py [sizes...]
+"""
+from __future__ import annotations
+import argparse, ast, io, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cfg import CFGVisitor, split_lines
+import synth
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('sizes', nargs='*', type=int, default=[1000, 10000, 100000])
+    args = arg_parser.parse_args()
+
+    print('recursion limit: {}'.format(sys.getrecursionlimit()))
+    print('{:>10} {:>10} {:>10} {:>12} {:>12}'.format('branches', 'blocks', 'edges', 'build', 'traverse'))
+    for n in args.sizes:
+        source = synth.sequential_branches(n)
+        tree = ast.parse(source)
+        start = time.perf_counter()
+        cfg = CFGVisitor().build('machine', tree, split_lines(source)).func_calls['machine']
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        cfg.write_dot(io.StringIO(), calls=False)
+        traverse = time.perf_counter() - start
+        print('{:>10} {:>10} {:>10} {:>10.2f} s {:>10.2f} s'.format(n, len(cfg.blocks), len(cfg.edges), build, traverse))
+
+
+if __name__ == '__main__':
+    main()
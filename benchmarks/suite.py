@@ -0,0 +1,226 @@
+"""Stage-by-stage timings and peak memory of cfg.py and cfg_orig.py on synthetic and real corpora.
+
+    python3 benchmarks/suite.py [--scale S] [--corpus DIR ...] [-o results.json] [--baseline old.json]
+
+Every synthetic generator of benchmarks/synth.py is run at three sizes (multiplied by --scale), and every
+--corpus directory is measured as one entry covering all of its Python files. Results are written as JSON, so
+runs of different versions can be compared with --baseline.
+"""
+from __future__ import annotations
+import argparse, ast, datetime, io, json, os, platform, subprocess, sys, time, tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cfg
+import cfg_orig
+import synth
+
+SIZES: Dict[str, Tuple[int, int, int]] = {
+    'straight_line': (100, 1000, 5000),
+    'if_chain': (10, 50, 200),
+    'sequential_branches': (100, 1000, 5000),
+    'deep_nesting': (5, 20, 60),
+    'try_finally': (5, 50, 200),
+    'comprehensions': (10, 100, 500),
+    'many_functions': (10, 100, 1000),
+    'realistic': (10, 50, 200),
+}
+
+
+class Stages:
+
+    def __init__(self):
+        self.times: Dict[str, float] = {}
+
+    @contextmanager
+    def __call__(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+
+def run_cfg(source: str, name: str, stage: Stages, reformat: bool = False, simplify: Optional[str] = None) -> int:
+    parser = cfg.PyParser(source, name)
+    if reformat:
+        with stage('strip'):
+            parser.removeCommentsAndDocstrings()
+        with stage('format'):
+            parser.formatCode()
+    with stage('parse'):
+        tree = parser.parse()
+        if not reformat:
+            tree = parser.removeDocstrings(tree)
+        lines = cfg.split_lines(parser.script)
+    with stage('build'):
+        graph = cfg.CFGVisitor().build(name, tree, lines)
+        graph.func_calls.build_all()
+    if simplify is not None:
+        with stage('simplify'):
+            graph.coalesce(compact=simplify == 'compact')
+    with stage('labels'):
+        graph.compute_labels()
+    with stage('dot'):
+        graph.write_dot(io.StringIO())
+    return sum(len(curr.live_blocks()) for curr in graphs(graph))
+
+
+def graphs(graph: cfg.CFG) -> Iterator[cfg.CFG]:
+    pending = [graph]
+    while pending:
+        curr = pending.pop()
+        yield curr
+        pending.extend(curr.func_calls.values())
+
+
+def run_cfg_reformat(source: str, name: str, stage: Stages) -> int:
+    return run_cfg(source, name, stage, reformat=True)
+
+
+def run_cfg_compact(source: str, name: str, stage: Stages) -> int:
+    return run_cfg(source, name, stage, simplify='compact')
+
+
+def run_orig(source: str, name: str, stage: Stages) -> int:
+    with stage('parse'):
+        tree = ast.parse(source, name)
+    with stage('build'):
+        graph = cfg_orig.CFGBuilder().build(name, tree)
+    blocks = 0
+    with stage('labels'):
+        pending = [graph]
+        while pending:
+            curr = pending.pop()
+            stack, seen = [curr.entryblock], {curr.entryblock.id}
+            while stack:
+                block = stack.pop()
+                blocks += 1
+                block.get_source()
+                block.get_calls()
+                for exit_ in block.exits:
+                    exit_.get_exitcase()
+                    if exit_.target.id not in seen:
+                        seen.add(exit_.target.id)
+                        stack.append(exit_.target)
+            pending.extend(curr.functioncfgs.values())
+    with stage('dot'):
+        graph._build_visual().source
+    return blocks
+
+
+BUILDERS: Dict[str, Callable[[str, str, Stages], int]] = {
+    'cfg': run_cfg,
+    'cfg --reformat': run_cfg_reformat,
+    'cfg --compact': run_cfg_compact,
+    'cfg_orig': run_orig,
+}
+
+
+def measure(run: Callable[[str, str, Stages], int], sources: List[Tuple[str, str]], repeat: int) -> Dict:
+    best: Optional[Dict[str, float]] = None
+    blocks = 0
+    try:
+        for _ in range(repeat):
+            stage = Stages()
+            blocks = sum(run(source, name, stage) for name, source in sources)
+            if best is None or sum(stage.times.values()) < sum(best.values()):
+                best = stage.times
+        tracemalloc.start()
+        try:
+            for name, source in sources:
+                run(source, name, Stages())
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    except (RecursionError, SyntaxError, ValueError, TypeError, AttributeError, KeyError, AssertionError) as e:
+        return {'error': '{}: {}'.format(type(e).__name__, str(e)[:200])}
+    return {'stages': best, 'total': sum(best.values()), 'peak_bytes': peak, 'blocks': blocks, 'error': None}
+
+
+def corpora(scale: float, dirs: List[str], only: Optional[List[str]]) -> Iterator[Tuple[str, int, List[Tuple[str, str]]]]:
+    for generator, sizes in SIZES.items():
+        if only and generator not in only:
+            continue
+        for size in sizes:
+            size = max(1, int(size * scale))
+            yield generator, size, [('{}_{}'.format(generator, size), synth.GENERATORS[generator](size))]
+    for directory in dirs:
+        sources = []
+        for root, subdirs, files in os.walk(directory):
+            subdirs.sort()
+            for name in sorted(files):
+                if name.endswith('.py'):
+                    path = os.path.join(root, name)
+                    try:
+                        with open(path) as f:
+                            source = f.read()
+                        ast.parse(source, path)
+                    except (OSError, UnicodeDecodeError, SyntaxError, ValueError):
+                        continue
+                    sources.append((path, source))
+        yield directory, len(sources), sources
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--scale', type=float, default=1.0, help='multiply every synthetic size by this factor')
+    arg_parser.add_argument('--corpus', action='append', default=[], help='directory of real Python files (repeatable)')
+    arg_parser.add_argument('--only', action='append', default=None, help='run only this synthetic generator (repeatable)')
+    arg_parser.add_argument('--builder', action='append', default=None, choices=list(BUILDERS), help='run only this builder (repeatable)')
+    arg_parser.add_argument('-n', '--repeat', type=int, default=3, help='keep the best of this many runs')
+    arg_parser.add_argument('-o', '--output', default='benchmark_results.json')
+    arg_parser.add_argument('--baseline', default=None, help='results of an earlier run to compare totals against')
+    arg_parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as a regression')
+    args = arg_parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(r['corpus'], r['size'], r['builder']): r for r in json.load(f)['results']}
+
+    results = []
+    regressions = 0
+    print('{:<22} {:>6} {:<15} {:>8} {:>10} {:>10}  {}'.format('corpus', 'size', 'builder', 'blocks', 'total', 'peak', 'stages / error'))
+    for corpus, size, sources in corpora(args.scale, args.corpus, args.only):
+        for builder in args.builder or BUILDERS:
+            result = dict(corpus=corpus, size=size, builder=builder, lines=sum(s.count('\n') + 1 for _, s in sources))
+            result.update(measure(BUILDERS[builder], sources, args.repeat))
+            results.append(result)
+            if result['error']:
+                print('{:<22} {:>6} {:<15} {:>8} {:>10} {:>10}  {}'.format(corpus[-22:], size, builder, '-', '-', '-', result['error']))
+                continue
+            line = '{:<22} {:>6} {:<15} {:>8} {:>8.1f}ms {:>7.1f}MiB  {}'.format(
+                corpus[-22:], size, builder, result['blocks'], 1000 * result['total'], result['peak_bytes'] / 2 ** 20,
+                ' '.join('{}={:.1f}'.format(k, 1000 * v) for k, v in result['stages'].items()))
+            old = baseline.get((corpus, size, builder))
+            if old and not old.get('error'):
+                ratio = result['total'] / old['total']
+                line += '  {:.2f}x baseline'.format(ratio)
+                if ratio > args.threshold:
+                    line += ' REGRESSION'
+                    regressions += 1
+            print(line)
+
+    meta = {'version': cfg.__version__, 'revision': git_revision(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'scale': args.scale, 'repeat': args.repeat}
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print('results written to {}'.format(args.output))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Synthetic Python modules for the benchmarks, scaled by a size parameter."""
+from __future__ import annotations
+import random
+from typing import Callable, Dict, List
+
+
+def straight_line(n: int) -> str:
+    lines = ['def straight():', '    """A long function without branches."""', '    x = 0']
+    for i in range(n):
+        lines.append('    x = x + {}  # step {}'.format(i, i))
+        if i % 10 == 0:
+            lines.append('    log(x)')
+    lines.append('    return x')
+    return '\n'.join(lines) + '\n'
+
+
+def if_chain(n: int) -> str:
+    lines = ['def dispatch(op, a, b):']
+    for i in range(n):
+        lines.append('    {} op == {}:'.format('if' if i == 0 else 'elif', i))
+        lines.append('        a = handle_{}(a, b)'.format(i))
+    lines.append('    else:')
+    lines.append('        raise ValueError(op)')
+    lines.append('    return a')
+    return '\n'.join(lines) + '\n'
+
+
+def sequential_branches(n: int) -> str:
+    # one huge function whose CFG is a chain of about 3n blocks, like a flattened state machine
+    lines = ['def machine(state, x):']
+    for i in range(n):
+        lines += ['    if state == {}:'.format(i), '        x = step(x, {})'.format(i)]
+    lines.append('    return x')
+    return '\n'.join(lines) + '\n'
+
+
+def deep_nesting(depth: int) -> str:
+    lines = ['def nested(items):', '    total = 0']
+    indent = '    '
+    for i in range(depth):
+        kind = i % 3
+        if kind == 0:
+            lines.append('{}for v{} in items:'.format(indent, i))
+        elif kind == 1:
+            lines.append('{}if v{} > {}:'.format(indent, i - 1, i))
+        else:
+            lines.append('{}while total < {}:'.format(indent, i * 10))
+        indent += '    '
+        lines.append('{}total += {}'.format(indent, i))
+    lines.append('    return total')
+    return '\n'.join(lines) + '\n'
+
+
+def try_finally(n: int) -> str:
+    lines = ['def guarded(path):']
+    for i in range(n):
+        lines += ['    try:',
+                  '        f{} = open(path)'.format(i),
+                  '        data = f{}.read()'.format(i),
+                  '    except OSError as e:',
+                  '        report(e)',
+                  '    except ValueError:',
+                  '        data = None',
+                  '    else:',
+                  '        data = parse(data)',
+                  '    finally:',
+                  '        close(f{})'.format(i)]
+    lines.append('    return data')
+    return '\n'.join(lines) + '\n'
+
+
+def comprehensions(n: int) -> str:
+    lines = ['def comps(xs, ys):']
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            lines.append('    l{} = [f(x) * {} for x in xs if x > {} for y in ys if y < x]'.format(i, i, i))
+        elif kind == 1:
+            lines.append('    s{} = {{g(x) for x in xs if x % {} == 0}}'.format(i, i + 2))
+        elif kind == 2:
+            lines.append('    d{} = {{x: h(y) for x, y in zip(xs, ys) if x != y}}'.format(i))
+        else:
+            lines.append('    e{} = (x + {} for x in xs if x)'.format(i, i))
+    lines.append('    return xs')
+    return '\n'.join(lines) + '\n'
+
+
+def function_body(rng: random.Random, name: str, size: int) -> List[str]:
+    lines = ['def {}(a, b=None):'.format(name), '    """Generated function {}."""'.format(name), '    result = []']
+    for i in range(size):
+        kind = rng.randrange(6)
+        if kind == 0:
+            lines += ['    if a > {}:'.format(i), '        result.append(compute(a, {}))'.format(i), '    else:',
+                      '        result.append(fallback({}))'.format(i)]
+        elif kind == 1:
+            lines += ['    for item in range(a):', '        if item == {}:'.format(i), '            break',
+                      '        result.append(item)']
+        elif kind == 2:
+            lines += ['    while b and b > {}:'.format(i), '        b -= 1']
+        elif kind == 3:
+            lines += ['    try:', '        result.append(risky({}))'.format(i), '    except KeyError:',
+                      '        pass']
+        elif kind == 4:
+            lines += ['    squares = [x * x for x in result if x > {}]'.format(i)]
+        else:
+            lines += ['    a = a + {}  # arithmetic'.format(i), '    b = helper(a, b)']
+    lines.append('    return result')
+    return lines
+
+
+def many_functions(n: int, size: int = 5, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    lines = ['"""Generated module with {} functions."""'.format(n), 'import os', '']
+    for i in range(n):
+        lines += function_body(rng, 'func_{}'.format(i), size)
+        lines.append('')
+    lines += ["if __name__ == '__main__':", '    func_0(1)']
+    return '\n'.join(lines) + '\n'
+
+
+def realistic(n: int, seed: int = 0) -> str:
+    # a mix of every shape, roughly n functions worth of code
+    rng = random.Random(seed)
+    parts = [many_functions(n, rng.randrange(3, 9), seed)]
+    for i in range(max(1, n // 20)):
+        parts += [straight_line(50).replace('straight', 'straight_{}'.format(i)),
+                  if_chain(20).replace('dispatch', 'dispatch_{}'.format(i)),
+                  try_finally(3).replace('guarded', 'guarded_{}'.format(i)),
+                  comprehensions(8).replace('comps', 'comps_{}'.format(i))]
+    return '\n\n'.join(parts)
+
+
+GENERATORS: Dict[str, Callable[[int], str]] = {
+    'straight_line': straight_line,
+    'if_chain': if_chain,
+    'sequential_branches': sequential_branches,
+    'deep_nesting': deep_nesting,
+    'try_finally': try_finally,
+    'comprehensions': comprehensions,
+    'many_functions': many_functions,
+    'realistic': realistic,
+}
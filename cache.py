@@ -0,0 +1,147 @@
+from __future__ import annotations
+import hashlib, os, pickle, tempfile
+from typing import Callable, Dict, List, Optional, Tuple
+
+from cfg import CFG, __version__, cache_format
+
+DEFAULT_MAX_BYTES: int = 512 * 1024 * 1024
+
+
+class CFGCache:
+    # On-disk cache of built CFGs keyed by a hash of the source text, the tool version and the build options.
+    # Every entry is one pickle file; its mtime is refreshed on every hit, so trimming by mtime evicts the least
+    # recently used entries first. The sizes of the entries stored since the last trim are appended to a ledger
+    # file, so that all processes and instances sharing the directory trim it once they wrote max_bytes / 8.
+
+    suffix: str = '.cfg'
+    ledger: str = 'written'
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self.stores: int = 0
+        self.evictions: int = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source: str, *options: str) -> str:
+        digest = hashlib.sha256()
+        for part in (__version__, str(cache_format)) + options:
+            digest.update(part.encode())
+            digest.update(b'\0')
+        digest.update(source.encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key: str) -> Optional[CFG]:
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                cfg = pickle.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # entries written by an incompatible version are treated as misses and dropped
+            self.misses += 1
+            self._discard(path)
+            return None
+        self.hits += 1
+        return cfg
+
+    def put(self, key: str, cfg: CFG) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(cfg, f, pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            self._discard(tmp)
+            raise
+        self.stores += 1
+        if self._record(size) > self.max_bytes // 8:
+            self.trim()
+
+    def _record(self, size: int) -> int:
+        # appends size to the ledger and returns the bytes it holds; appends this short are atomic
+        path = os.path.join(self.directory, self.ledger)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, b'%d\n' % size)
+        finally:
+            os.close(fd)
+        with open(path, 'rb') as f:
+            return sum(int(line) for line in f.read().split() if line.isdigit())
+
+    def get_or_build(self, source: str, name: str, build: Callable[[], CFG], *options: str) -> Tuple[CFG, bool]:
+        key = self.key(source, *options)
+        cfg = self.get(key)
+        if cfg is not None:
+            # identical sources at different paths share one entry
+            cfg.name = name
+            return cfg, True
+        cfg = build()
+        self.put(key, cfg)
+        return cfg, False
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(self.suffix):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def trim(self) -> int:
+        self._discard(os.path.join(self.directory, self.ledger))
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._discard(path)
+            total -= size
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def clear(self) -> None:
+        for _, _, path in self.entries():
+            self._discard(path)
+        self._discard(os.path.join(self.directory, self.ledger))
+
+    def info(self) -> Dict[str, int]:
+        entries = self.entries()
+        return {'entries': len(entries), 'bytes': sum(size for _, size, _ in entries), 'max_bytes': self.max_bytes}
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores, 'evictions': self.evictions}
+
+    def _discard(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Inspect or clear a CFG cache directory.')
+    arg_parser.add_argument('directory')
+    arg_parser.add_argument('--clear', action='store_true', help='remove every entry')
+    args = arg_parser.parse_args()
+    cache = CFGCache(args.directory)
+    if args.clear:
+        cache.clear()
+    info = cache.info()
+    print('{}: {} entries, {:.1f} MiB'.format(args.directory, info['entries'], info['bytes'] / 2 ** 20))
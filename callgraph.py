@@ -0,0 +1,342 @@
+from __future__ import annotations
+import ast, json, os, sys
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Set, Tuple
+
+from cfg import CFG, FuncCalls, build_from_source
+
+
+class CallSite(NamedTuple):
+    caller: str
+    block: int
+    name: str
+    callee: Optional[str]
+
+
+def module_name(path: str) -> Tuple[str, bool]:
+    # (dotted module name, whether it is a package) of a source file, counted from the first directory above it
+    # that is not a package, as the import system would see it with that directory on sys.path
+    path = os.path.abspath(path)
+    directory, filename = os.path.split(path)
+    parts = [] if filename == '__init__.py' else [os.path.splitext(filename)[0]]
+    while os.path.isfile(os.path.join(directory, '__init__.py')):
+        directory, package = os.path.split(directory)
+        parts.insert(0, package)
+    return '.'.join(parts) or os.path.splitext(filename)[0], filename == '__init__.py'
+
+
+class CallGraph:
+    # Interprocedural call graph over the CFGs of one or more modules. Functions are identified by qualified names:
+    # the module name followed by the names of the enclosing functions (pkg.mod.outer.inner); the code at the top
+    # level of a module is the module name itself. The names recorded in BasicBlock.calls are resolved against
+    # the functions of the calling graph and the graphs enclosing it, then against the imports in those graphs
+    # and the top-level functions of the other modules; calls through self. or cls. are looked up among the
+    # functions next to the caller, where the visitor puts the other methods of its class. Anything else, such as
+    # builtins and library functions, stays unresolved.
+    # The callees of a function are resolved when it is first expanded, and expanding only needs the CFG of that
+    # function, so reachable() only builds the function CFGs it reaches. callers() needs the whole index and
+    # expands every function.
+
+    def __init__(self, modules: Optional[Mapping[str, CFG]] = None, packages: Optional[Dict[str, str]] = None):
+        # modules and packages (module -> package relative imports start from) can be given as mappings that load
+        # modules on demand; add() needs a mutable one
+        self.modules: Mapping[str, CFG] = modules if modules is not None else {}
+        self.packages: Dict[str, str] = packages if packages is not None else {}
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.callees: List[Optional[List[int]]] = []
+        self.sites: List[List[CallSite]] = []
+        self.callers: Optional[List[List[int]]] = None
+        self.imports: Dict[str, Tuple[Dict[str, str], List[str]]] = {}
+        # functions whose CFG could not be built; they are kept as functions without calls
+        self.errors: Dict[str, str] = {}
+
+    def add(self, cfg: CFG, module: Optional[str] = None, package: bool = False) -> None:
+        # package: the module is the __init__ of a package, which relative imports start from
+        module = module or cfg.name
+        self.modules[module] = cfg
+        self.packages[module] = module if package else module.rpartition('.')[0]
+        self.callers = None
+
+    def node(self, name: str) -> int:
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.callees.append(None)
+            self.sites.append([])
+            if self.callers is not None:
+                self.callers.append([])
+        return self.ids[name]
+
+    def split(self, name: str) -> Tuple[Optional[str], List[str]]:
+        # (module, names of the enclosing functions) of a qualified name, taking the longest module that matches
+        parts = name.split('.')
+        for i in range(len(parts), 0, -1):
+            module = '.'.join(parts[:i])
+            if module in self.modules:
+                return module, parts[i:]
+        return None, []
+
+    def graph(self, name: str) -> Optional[CFG]:
+        module, path = self.split(name)
+        graph = self.modules.get(module)
+        for part in path:
+            if graph is None or part not in graph.func_calls:
+                return None
+            graph = graph.func_calls[part]
+        return graph
+
+    def exists(self, name: str) -> bool:
+        # checks the names only, so unlike graph() it builds nothing but the enclosing functions
+        module, path = self.split(name)
+        if module is None:
+            return False
+        graph = self.modules[module]
+        for i, part in enumerate(path):
+            if part not in graph.func_calls:
+                return False
+            if i < len(path) - 1:
+                graph = graph.func_calls[part]
+        return True
+
+    def resolve_global(self, name: str, depth: int = 0) -> Optional[str]:
+        # follows re-exports such as a package __init__ importing a function from one of its modules
+        if self.exists(name):
+            return name
+        module, path = self.split(name)
+        if module is None or not path or depth > 8:
+            return None
+        aliases, stars = self.import_table(module, self.modules[module])
+        if path[0] in aliases:
+            return self.resolve_global('.'.join([aliases[path[0]]] + path[1:]), depth + 1)
+        for star in stars:
+            target = self.resolve_global('.'.join([star] + path), depth + 1)
+            if target is not None:
+                return target
+        return None
+
+    def import_table(self, name: str, graph: CFG) -> Tuple[Dict[str, str], List[str]]:
+        # local name -> qualified name of what it was imported as, and the modules imported with *
+        if name not in self.imports:
+            aliases, stars = {}, []
+            module, path = self.split(name)
+            for block in graph.live_blocks():
+                for stmt in block.stmts:
+                    if type(stmt) == ast.Import:
+                        for alias in stmt.names:
+                            if alias.asname:
+                                aliases[alias.asname] = alias.name
+                            else:
+                                head = alias.name.partition('.')[0]
+                                aliases[head] = head
+                    elif type(stmt) == ast.ImportFrom:
+                        base = stmt.module or ''
+                        if stmt.level:
+                            package = self.packages.get(module, '').split('.') if module is not None else []
+                            package = package[:len(package) - stmt.level + 1] if stmt.level > 1 else package
+                            base = '.'.join([p for p in package if p] + ([stmt.module] if stmt.module else []))
+                        for alias in stmt.names:
+                            if alias.name == '*':
+                                stars.append(base)
+                            else:
+                                aliases[alias.asname or alias.name] = base + '.' + alias.name if base else alias.name
+            self.imports[name] = (aliases, stars)
+        return self.imports[name]
+
+    def scopes(self, name: str) -> Iterator[Tuple[str, CFG]]:
+        # the graph of name and the graphs enclosing it, innermost first
+        module, path = self.split(name)
+        chain = [(module, self.modules[module])]
+        for part in path:
+            chain.append((chain[-1][0] + '.' + part, chain[-1][1].func_calls[part]))
+        return reversed(chain)
+
+    def resolve(self, caller: str, name: str) -> Optional[str]:
+        head, _, rest = name.partition('.')
+        scopes = list(self.scopes(caller))
+        if head in ('self', 'cls') and rest:
+            head, _, rest = rest.partition('.')
+            scopes = scopes[1:]
+        for scope, graph in scopes:
+            if head in graph.func_calls:
+                target = scope + '.' + head + ('.' + rest if rest else '')
+                return target if self.exists(target) else None
+            aliases, stars = self.import_table(scope, graph)
+            if head in aliases:
+                return self.resolve_global(aliases[head] + ('.' + rest if rest else ''))
+            for star in stars:
+                target = self.resolve_global(star + '.' + name)
+                if target is not None:
+                    return target
+        return None
+
+    def expand(self, node: int) -> List[int]:
+        if self.callees[node] is None:
+            caller = self.names[node]
+            try:
+                graph = self.graph(caller)
+            except Exception as e:
+                graph = None
+                self.errors[caller] = '{}: {}'.format(type(e).__name__, e)
+            callees, sites = [], []
+            seen = set()
+            for block in graph.live_blocks() if graph is not None else []:
+                for name in block.calls:
+                    if name is None:
+                        continue
+                    callee = self.resolve(caller, name)
+                    sites.append(CallSite(caller, block.bid, name, callee))
+                    if callee is not None and callee not in seen:
+                        seen.add(callee)
+                        callees.append(self.node(callee))
+            self.callees[node], self.sites[node] = callees, sites
+            if self.callers is not None:
+                for callee in callees:
+                    self.callers[callee].append(node)
+        return self.callees[node]
+
+    def functions(self) -> Iterator[str]:
+        # every graph of every module, in the order of func_calls; builds all of them but those that fail
+        for module, cfg in self.modules.items():
+            pending = [(module, cfg)]
+            while pending:
+                name, graph = pending.pop()
+                yield name
+                if graph is None:
+                    continue
+                for k in reversed(list(graph.func_calls)):
+                    try:
+                        pending.append((name + '.' + k, graph.func_calls[k]))
+                    except Exception as e:
+                        pending.append((name + '.' + k, None))
+                        self.errors[name + '.' + k] = '{}: {}'.format(type(e).__name__, e)
+
+    def expand_all(self) -> None:
+        for name in self.functions():
+            self.expand(self.node(name))
+        if self.callers is None:
+            self.callers = [[] for _ in self.names]
+            for node, callees in enumerate(self.callees):
+                for callee in callees or ():
+                    self.callers[callee].append(node)
+
+    def find(self, name: str) -> List[str]:
+        # a qualified name as it is, otherwise every module-level function or module of that name
+        if self.exists(name):
+            return [name]
+        return [module + '.' + name for module in self.modules if self.exists(module + '.' + name)]
+
+    def reachable(self, roots: Iterable[str]) -> List[str]:
+        # every function that can be called, directly or not, from the roots, in breadth-first order
+        order = [self.node(name) for name in roots]
+        seen = set(order)
+        queue = deque(order)
+        while queue:
+            for callee in self.expand(queue.popleft()):
+                if callee not in seen:
+                    seen.add(callee)
+                    order.append(callee)
+                    queue.append(callee)
+        return [self.names[node] for node in order]
+
+    def callees_of(self, name: str) -> List[str]:
+        return [self.names[node] for node in self.expand(self.node(name))]
+
+    def callers_of(self, name: str) -> List[str]:
+        self.expand_all()
+        return [self.names[node] for node in self.callers[self.node(name)]]
+
+    def call_sites(self, name: str) -> List[CallSite]:
+        # the calls made by name, one per called name in every block
+        node = self.node(name)
+        self.expand(node)
+        return self.sites[node]
+
+    def calls_to(self, name: str) -> List[CallSite]:
+        self.expand_all()
+        return [site for caller in self.callers[self.node(name)] for site in self.sites[caller] if site.callee == name]
+
+    def to_dict(self, names: Optional[Iterable[str]] = None) -> Dict:
+        # the given functions (all of them by default) and the calls they make
+        if names is None:
+            self.expand_all()
+            names = self.names
+        names = list(names)
+        sites = [site for name in names for site in self.call_sites(name)]
+        return {'functions': names, 'calls': [site._asdict() for site in sites], 'errors': self.errors}
+
+    def restrict(self, cfg: CFG, module: str, keep: Set[str]) -> CFG:
+        # a copy of the CFG of module without the functions that are neither in keep nor enclose one that is;
+        # blocks are shared with the original and functions that are left out are never built. Functions that
+        # fail to build are left out as well and recorded in errors
+        copy = CFG.__new__(CFG)
+        copy.__setstate__(cfg.__getstate__())
+        copy.func_calls = FuncCalls()
+        for name in cfg.func_calls:
+            qualified = module + '.' + name
+            if qualified in self.errors:
+                continue
+            if qualified in keep or any(k.startswith(qualified + '.') for k in keep):
+                try:
+                    graph = cfg.func_calls[name]
+                except Exception as e:
+                    self.errors[qualified] = '{}: {}'.format(type(e).__name__, e)
+                    continue
+                copy.func_calls[name] = self.restrict(graph, qualified, keep)
+        return copy
+
+
+def run(paths: Iterable[str], pattern: str = '*.py', roots: Optional[List[str]] = None, callgraph_path: Optional[str] = None,
+        output_dir: Optional[str] = None, emit: str = 'graph', fmt: str = 'pdf', reformat: bool = False,
+        strict: bool = False) -> int:
+    # Builds the modules of all files in this process, so calls are resolved across them, and writes the call
+    # graph as JSON and/or the CFGs. With roots, both are limited to the functions reachable from them and
+    # functions that are not reachable are never built. Returns the number of files that failed.
+    from batch import iter_sources, output_path
+    callgraph = CallGraph()
+    files: Dict[str, str] = {}
+    failed = 0
+    for path in iter_sources(paths, pattern):
+        try:
+            with open(path, 'r') as f:
+                source = f.read()
+            module, package = module_name(path)
+            callgraph.add(build_from_source(source, module, reformat, strict), module, package)
+            files[module] = path
+        except Exception as e:
+            failed += 1
+            print('{}: {}: {}'.format(path, type(e).__name__, e), file=sys.stderr)
+
+    names = None
+    if roots:
+        found = [match for root in roots for match in callgraph.find(root)]
+        for root in roots:
+            if not callgraph.find(root):
+                print('{}: no such function'.format(root), file=sys.stderr)
+        names = callgraph.reachable(found)
+    if callgraph_path is not None:
+        data = callgraph.to_dict(names)
+        with open(callgraph_path, 'w') as f:
+            json.dump(data, f)
+    if output_dir is not None:
+        # the reachable functions of every module, leaving those of its submodules to them
+        owned: Optional[Dict[str, Set[str]]] = None
+        if names is not None:
+            owned = {}
+            for name in names:
+                owned.setdefault(callgraph.split(name)[0], set()).add(name)
+        for module, cfg in callgraph.modules.items():
+            if owned is not None and module not in owned:
+                continue
+            target = output_path(output_dir, files[module])
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                if owned is not None:
+                    cfg = callgraph.restrict(cfg, module, owned[module])
+                cfg.save(target, emit, fmt, show=False)
+            except Exception as e:
+                failed += 1
+                print('{}: {}: {}'.format(files[module], type(e).__name__, e), file=sys.stderr)
+    for name, error in callgraph.errors.items():
+        print('{}: {}'.format(name, error), file=sys.stderr)
+    return failed + len(callgraph.errors)
@@ -1,7 +1,15 @@
 from __future__ import annotations
-import ast, astor, autopep8, tokenize, io, sys
+import ast, astor, copy, gzip, hashlib, multiprocessing, pickle, tokenize, io, json, os, sys, textwrap
 import graphviz as gv
-from typing import Dict, List, Tuple, Set, Optional, Type
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, List, NamedTuple, Tuple, Set, Optional, TextIO, Type, Union
+
+from profiler import Profiler, stage
+
+__version__ = '0.2.0'
+# version of the pickled CFG, BasicBlock and FuncCalls objects, part of the cache keys; bumped whenever their
+# attributes or the contents of the built blocks change
+cache_format = 8
 
 # TODO later: graph
 '''
@@ -9,31 +17,110 @@ from typing import Dict, List, Tuple, Set, Optional, Type
 2. node shape (may be added into class Block)
 '''
 
-class SingletonMeta(type):
-    _instance: Optional[BlockId] = None
-
-    def __call__(self) -> BlockId:
-        if self._instance is None:
-            self._instance = super().__call__()
-        return self._instance
+class BlockId:
+    # One allocator per CFG build, so ids are dense, start at 1 in every graph and never leak between builds or threads.
 
-
-class BlockId(metaclass=SingletonMeta):
-    counter: int = 0
+    def __init__(self):
+        self.counter: int = 0
 
     def gen(self) -> int:
         self.counter += 1
         return self.counter
 
 
+# Labels are sliced from the source the tree was parsed from whenever the node carries a location; synthetic
+# nodes created by the visitor fall back to astor. Either way the cost is proportional to the label, not to the
+# subtree below it.
+
+header_stmts: Tuple[Type[ast.AST], ...] = (ast.If, ast.For, ast.While, ast.FunctionDef, ast.AsyncFunctionDef)
+
+
+def split_lines(source: str) -> List[str]:
+    # same line breaks as the tokenizer, unlike str.splitlines which also splits on form feeds etc.
+    return io.StringIO(source, newline='').readlines()
+
+
+def slice_source(lines: List[str], lineno: int, col: int, end_lineno: int, end_col: int) -> str:
+    # ast column offsets count utf-8 bytes
+    def cut(line: str, start: int, end: Optional[int] = None) -> str:
+        return line[start:end] if line.isascii() else line.encode()[start:end].decode()
+
+    if lineno == end_lineno:
+        return cut(lines[lineno - 1], col, end_col)
+    text = cut(lines[lineno - 1], col) + ''.join(lines[lineno:end_lineno - 1]) + cut(lines[end_lineno - 1], 0, end_col)
+    return textwrap.dedent(' ' * col + text).strip()
+
+
+def source_segment(lines: Optional[List[str]], node: Type[ast.AST]) -> Optional[str]:
+    position = [getattr(node, attr, None) for attr in ('lineno', 'col_offset', 'end_lineno', 'end_col_offset')]
+    if lines is None or None in position:
+        return None
+    return slice_source(lines, *position)
+
+
+def header_to_code(stmt: Type[ast.AST], lines: Optional[List[str]]) -> str:
+    # the first line of a compound statement, without regenerating its body
+    last = stmt.iter if type(stmt) == ast.For else getattr(stmt, 'test', None)
+    if last is not None and None not in [getattr(stmt, 'lineno', None), getattr(last, 'end_lineno', None)] and lines is not None:
+        return slice_source(lines, stmt.lineno, stmt.col_offset, last.end_lineno, last.end_col_offset) + ':'
+    header = copy.copy(stmt)
+    header.body = [ast.Pass()]
+    if hasattr(header, 'orelse'):
+        header.orelse = []
+    if hasattr(header, 'decorator_list'):
+        header.decorator_list = []
+    return astor.to_source(header).split('\n')[0]
+
+
+def stmt_to_code(stmt: Type[ast.AST], lines: Optional[List[str]] = None) -> str:
+    if isinstance(stmt, header_stmts):
+        return header_to_code(stmt, lines) + '\n'
+    segment = source_segment(lines, stmt)
+    return segment + '\n' if segment is not None else astor.to_source(stmt)
+
+
+class EdgeSet(dict):
+    # Insertion-ordered set of block ids with the list methods the builder uses: membership, append and removal
+    # are O(1) and iteration follows insertion order, so rendering stays deterministic. Most blocks have one or two
+    # neighbours and keep them in a plain list, which is a third of the size; BasicBlock switches a list to an
+    # EdgeSet once it reaches promote_at ids, so the scans over lists stay bounded.
+    __slots__ = ()
+    promote_at: int = 8
+
+    def append(self, bid: int) -> None:
+        self[bid] = None
+
+    def remove(self, bid: int) -> None:
+        self.pop(bid, None)
+
+    def __repr__(self) -> str:
+        return '{}({})'.format(type(self).__name__, list(self))
+
+
 class BasicBlock:
+    __slots__ = ('bid', 'stmts', 'calls', 'prev', 'next', 'code')
 
     def __init__(self, bid: int):
         self.bid: int = bid
         self.stmts: List[Type[ast.AST]] = []
-        self.calls: List[str] = []
-        self.prev: List[int] = []
-        self.next: List[int] = []
+        # None for calls that get_function_name cannot resolve
+        self.calls: List[Optional[str]] = []
+        self.prev: Union[List[int], EdgeSet] = []
+        self.next: Union[List[int], EdgeSet] = []
+        self.code: Optional[str] = None
+
+    # an edge added twice is only kept once
+    def add_prev(self, prev_bid: int) -> None:
+        if prev_bid not in self.prev:
+            if len(self.prev) >= EdgeSet.promote_at and type(self.prev) is list:
+                self.prev = EdgeSet.fromkeys(self.prev)
+            self.prev.append(prev_bid)
+
+    def add_next(self, next_bid: int) -> None:
+        if next_bid not in self.next:
+            if len(self.next) >= EdgeSet.promote_at and type(self.next) is list:
+                self.next = EdgeSet.fromkeys(self.next)
+            self.next.append(next_bid)
 
     def is_empty(self) -> bool:
         return len(self.stmts) == 0
@@ -52,16 +139,272 @@ class BasicBlock:
         if next_bid in self.next:
             self.next.remove(next_bid)
 
-    def stmts_to_code(self) -> str:
-        code = ''
-        for stmt in self.stmts:
-            line = astor.to_source(stmt)
-            code += line.split('\n')[0] + "\n" if type(stmt) in [ast.If, ast.For, ast.While, ast.FunctionDef,
-                                                                 ast.AsyncFunctionDef] else line
-        return code
+    def stmts_to_code(self, lines: Optional[List[str]] = None) -> str:
+        # memoized: labels are only asked for once the block is complete
+        if self.code is None:
+            self.code = ''.join(stmt_to_code(stmt, lines) for stmt in self.stmts)
+        return self.code
 
     def calls_to_code(self) -> str:
-        return '\n'.join(self.calls)
+        return '\n'.join(call for call in self.calls if call is not None)
+
+
+class BinaryWriter:
+    # Unsigned LEB128 varints, and strings that are written once and referenced by index afterwards.
+
+    def __init__(self):
+        self.out: bytearray = bytearray()
+        self.strings: Dict[str, int] = {}
+
+    def varint(self, n: int) -> None:
+        while n > 0x7f:
+            self.out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        self.out.append(n)
+
+    def string(self, s: str) -> None:
+        # 0 introduces a new string, k > 0 refers to the k-th string seen so far
+        if s in self.strings:
+            self.varint(self.strings[s])
+        else:
+            self.strings[s] = len(self.strings) + 1
+            data = s.encode('utf-8', 'surrogatepass')
+            self.varint(0)
+            self.varint(len(data))
+            self.out += data
+
+
+class BinaryReader:
+
+    def __init__(self, data: bytes, pos: int = 0):
+        self.data: bytes = data
+        self.pos: int = pos
+        self.strings: List[str] = []
+
+    def varint(self) -> int:
+        n = shift = 0
+        while True:
+            byte = self.data[self.pos]
+            self.pos += 1
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    def string(self) -> str:
+        ref = self.varint()
+        if ref:
+            return self.strings[ref - 1]
+        length = self.varint()
+        s = self.data[self.pos:self.pos + length].decode('utf-8', 'surrogatepass')
+        self.pos += length
+        self.strings.append(s)
+        return s
+
+
+class DotWriter:
+    # Streams DOT statements straight to a text file as they are produced. It offers the node/edge interface of
+    # graphviz.Digraph that CFG._traverse draws with, so no DOT body is accumulated in memory.
+
+    def __init__(self, out: TextIO, depth: int = 1):
+        self.out: TextIO = out
+        self.indent: str = '\t' * depth
+
+    @staticmethod
+    def quote(s: str) -> str:
+        return '"' + s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+    def attributes(self, label: Optional[str], attributes: Optional[Dict[str, str]]) -> str:
+        items = ([('label', label)] if label is not None else []) + list((attributes or {}).items())
+        return ' [' + ' '.join('{}={}'.format(k, self.quote(v)) for k, v in items) + ']' if items else ''
+
+    def node(self, name: str, label: Optional[str] = None, _attributes: Optional[Dict[str, str]] = None) -> None:
+        self.out.write('{}{}{}\n'.format(self.indent, self.quote(name), self.attributes(label, _attributes)))
+
+    def edge(self, tail_name: str, head_name: str, label: Optional[str] = None, _attributes: Optional[Dict[str, str]] = None) -> None:
+        self.out.write('{}{} -> {}{}\n'.format(self.indent, self.quote(tail_name), self.quote(head_name), self.attributes(label, _attributes)))
+
+
+# Cooper, Harvey and Kennedy, "A Simple, Fast Dominance Algorithm". Nodes are numbered in postorder and the
+# idom array is refined in reverse postorder until it is stable, which takes two or three passes on the graphs
+# the visitor builds (they are reducible except for try statements), so the cost stays close to linear.
+def immediate_dominators(root: int, successors: Dict[int, List[int]], predecessors: Dict[int, List[int]]) -> Dict[int, int]:
+    # maps every node reachable from root to its immediate dominator, root to itself
+    order: List[int] = []
+    seen = {root}
+    stack = [(root, iter(successors[root]))]
+    while stack:
+        node, it = stack[-1]
+        for succ in it:
+            if succ not in seen:
+                seen.add(succ)
+                stack.append((succ, iter(successors[succ])))
+                break
+        else:
+            stack.pop()
+            order.append(node)
+    number = {node: i for i, node in enumerate(order)}
+    preds = [[number[p] for p in predecessors[node] if p in number] for node in order]
+    idom = [-1] * len(order)
+    idom[-1] = len(order) - 1
+    changed = True
+    while changed:
+        changed = False
+        for b in range(len(order) - 2, -1, -1):
+            new_idom = -1
+            for p in preds[b]:
+                if idom[p] == -1:
+                    continue
+                if new_idom == -1:
+                    new_idom = p
+                    continue
+                a = p
+                while a != new_idom:
+                    while a < new_idom:
+                        a = idom[a]
+                    while new_idom < a:
+                        new_idom = idom[new_idom]
+            if idom[b] != new_idom:
+                idom[b] = new_idom
+                changed = True
+    return {node: order[idom[i]] for i, node in enumerate(order)}
+
+
+def dominance_frontiers(idom: Dict[int, int], predecessors: Dict[int, List[int]]) -> Dict[int, Set[int]]:
+    # the frontier of n: nodes with a predecessor dominated by n that n does not strictly dominate
+    frontiers: Dict[int, Set[int]] = {node: set() for node in idom}
+    for node in idom:
+        preds = [p for p in predecessors[node] if p in idom]
+        # the root is also entered from outside, so one edge back to it already makes it a join
+        is_root = idom[node] == node
+        if len(preds) > 1 or is_root and preds:
+            stop = None if is_root else idom[node]
+            for runner in preds:
+                while runner != stop:
+                    frontiers[runner].add(node)
+                    runner = stop if idom[runner] == runner else idom[runner]
+    return frontiers
+
+
+class CSRGraph(NamedTuple):
+    # Compressed sparse row adjacency of a CFG and all of its nested function CFGs, which form consecutive
+    # diagonal blocks: the nodes of graphs[g] are graph_ptr[g]:graph_ptr[g + 1], its entry node is starts[g] and
+    # node i stands for block block_ids[i] of that graph. The successors of node i are
+    # indices[indptr[i]:indptr[i + 1]] in the order of BasicBlock.next, and kinds holds the matching indices
+    # into CFG.edge_kinds.
+    indptr: Any
+    indices: Any
+    kinds: Any
+    block_ids: Any
+    graph_ptr: Any
+    starts: Any
+    graphs: List[str]
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.block_ids)
+
+    def to_scipy(self):
+        import scipy.sparse  # optional, only needed for the sparse matrix view
+        return scipy.sparse.csr_array((self.kinds.astype('int8') + 1, self.indices, self.indptr), shape=(self.num_nodes, self.num_nodes))
+
+    def reachable(self, node: int):
+        # nodes reachable from node, in breadth-first order
+        from scipy.sparse.csgraph import breadth_first_order
+        return breadth_first_order(self.to_scipy(), node, directed=True, return_predecessors=False)
+
+    def strongly_connected_components(self):
+        # (number of components, component label of every node)
+        from scipy.sparse.csgraph import connected_components
+        return connected_components(self.to_scipy(), directed=True, connection='strong')
+
+
+class FuncCalls(MutableMapping):
+    # name -> CFG of a function or lambda. The visitor only stores the tree of every function it meets; its CFG is
+    # built on first access and then kept, so looking up one function costs only the build of that function.
+    # Names, their order, len and `in` never build anything; values(), items() and pickling build every pending one.
+    # The trees stay known after the build, for rebuild_from_source to tell which functions changed.
+
+    def __init__(self, graphs: Optional[Dict[str, CFG]] = None):
+        self.graphs: Dict[str, Optional[CFG]] = {}
+        self.pending: Dict[str, Tuple[Type[ast.AST], Optional[List[str]], Optional[Profiler]]] = {}
+        self.trees: Dict[str, Type[ast.AST]] = {}
+        if graphs:
+            self.update(graphs)
+
+    def defer(self, name: str, tree: Type[ast.AST], source_lines: Optional[List[str]], profiler: Optional[Profiler] = None) -> None:
+        # keeps the place of the function; a later function of the same name replaces it, as a dict would
+        self.graphs[name] = None
+        self.pending[name] = (tree, source_lines, profiler)
+        self.trees[name] = tree
+
+    def adopt(self, name: str, graph: CFG, tree: Type[ast.AST]) -> None:
+        # stores a CFG that was built from tree elsewhere
+        self.pending.pop(name, None)
+        self.graphs[name] = graph
+        self.trees[name] = tree
+
+    def is_built(self, name: str) -> bool:
+        return name in self.graphs and name not in self.pending
+
+    def __getitem__(self, name: str) -> CFG:
+        graph = self.graphs[name]
+        if name in self.pending:
+            # stays pending if the build fails, so the next access raises again
+            tree, lines, profiler = self.pending[name]
+            graph = self.graphs[name] = CFGVisitor(profiler).build(name, ast.Module(body=tree.body), lines)
+            del self.pending[name]
+        return graph
+
+    def __setitem__(self, name: str, graph: CFG) -> None:
+        self.pending.pop(name, None)
+        self.trees.pop(name, None)
+        self.graphs[name] = graph
+
+    def __delitem__(self, name: str) -> None:
+        del self.graphs[name]
+        self.pending.pop(name, None)
+        self.trees.pop(name, None)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.graphs
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.graphs)
+
+    def __len__(self) -> int:
+        return len(self.graphs)
+
+    def __repr__(self) -> str:
+        return '<FuncCalls of {} functions, {} not built>'.format(len(self.graphs), len(self.pending))
+
+    def __reduce__(self) -> Tuple:
+        # the trees are those of FunctionDef statements of the enclosing graph, which are pickled anyway
+        return (FuncCalls, (dict(self.items()),), {'trees': self.trees})
+
+    def build_all(self, jobs: int = 1) -> None:
+        # Builds every pending function, on a pool of jobs processes if jobs > 1. Forked workers read the functions
+        # from their copy of this process's memory, build their CFGs and labels and send them back packed, with
+        # every node of the function's tree replaced by its path from the function node, which is followed back to
+        # the node itself here: unpickling whole trees would cost more than building them. Materializing the CFGs
+        # still costs this process about half of a sequential build, so the gain comes from the visitor and label
+        # work done by the workers. The CFGs are the same as those of the sequential build.
+        global subgraph_functions
+        functions = [(name, tree, lines) for name, (tree, lines, profiler) in self.pending.items()]
+        if jobs <= 1 or len(functions) < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+            for name, tree, lines in functions:
+                self[name]
+            return
+        jobs = min(jobs, len(functions))
+        subgraph_functions = functions
+        try:
+            with multiprocessing.get_context('fork').Pool(jobs) as pool:
+                results = pool.map(build_subgraph, range(len(functions)), chunksize=max(1, len(functions) // (4 * jobs)))
+        finally:
+            subgraph_functions = []
+        for (name, tree, lines), data in zip(functions, results):
+            packed = SubgraphUnpickler(io.BytesIO(data), tree, lines).load()
+            self.adopt(name, CFG.unpack(packed, lines), tree)
 
 
 class CFG:
@@ -73,33 +416,579 @@ class CFG:
         # And I think list finalblocks is also not used.
 
         self.start: Optional[BasicBlock] = None
-        self.func_calls: Dict[str, CFG] = {}
+        self.func_calls: FuncCalls = FuncCalls()
         self.blocks: Dict[int, BasicBlock] = {}
         self.edges: Dict[Tuple[int, int], Type[ast.AST]] = {}
-        self.graph: Optional[gv.dot.Digraph] = None
-
-    def _traverse(self, block: BasicBlock, visited: Set[int] = set(), calls: bool = True) -> None:
-        if block.bid not in visited:
-            visited.add(block.bid)
-            self.graph.node(str(block.bid), label=block.stmts_to_code())
-            if calls and block.calls:
-                self.graph.node(str(block.bid) + '_call', label=block.calls_to_code(), _attributes={'shape': 'box'})
-                self.graph.edge(str(block.bid), str(block.bid) + '_call', label="calls", _attributes={'style': 'dashed'})
-
+        self.edge_labels: Dict[Tuple[int, int], str] = {}
+        self.source_lines: Optional[List[str]] = None
+        # results of the analyses below, computed on first use; the graph must not change afterwards
+        self.analyses: Dict[Tuple[str, bool], Any] = {}
+
+    def __getstate__(self) -> Dict:
+        # analyses are cheap to redo
+        state = self.__dict__.copy()
+        state['analyses'] = {}
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        state.setdefault('analyses', {})
+        self.__dict__.update(state)
+
+    def _traverse(self, graph: DotWriter, block: BasicBlock, visited: Optional[Set[int]] = None, calls: bool = True,
+                  prefix: str = '') -> None:
+        # Depth-first walk with an explicit stack, so graphs of any size stay clear of the recursion limit.
+        # Nodes are emitted when first reached and edges once the walk below their target is done, which is the
+        # order the recursive version produced. A frame is [block, successor iterator, successor being walked].
+        visited = set() if visited is None else visited
+        if block.bid in visited:
+            return
+        visited.add(block.bid)
+        self._traverse_node(graph, block, calls, prefix)
+        stack: List[List] = [[block, iter(block.next), None]]
+        while stack:
+            frame = stack[-1]
+            curr, successors, _ = frame
+            next_bid = next(successors, None)
+            if next_bid is None:
+                stack.pop()
+                if stack:
+                    parent = stack[-1]
+                    self._traverse_edge(graph, parent[0], parent[2], prefix)
+            elif next_bid not in visited:
+                visited.add(next_bid)
+                next_block = self.blocks[next_bid]
+                self._traverse_node(graph, next_block, calls, prefix)
+                frame[2] = next_bid
+                stack.append([next_block, iter(next_block.next), None])
+            else:
+                self._traverse_edge(graph, curr, next_bid, prefix)
+
+    def _traverse_node(self, graph: DotWriter, block: BasicBlock, calls: bool, prefix: str) -> None:
+        graph.node(prefix + str(block.bid), label=block.stmts_to_code(self.source_lines))
+        if calls and any(call is not None for call in block.calls):
+            graph.node(prefix + str(block.bid) + '_call', label=block.calls_to_code(), _attributes={'shape': 'box'})
+            graph.edge(prefix + str(block.bid), prefix + str(block.bid) + '_call', label="calls", _attributes={'style': 'dashed'})
+
+    def _traverse_edge(self, graph: DotWriter, block: BasicBlock, next_bid: int, prefix: str) -> None:
+        graph.edge(prefix + str(block.bid), prefix + str(next_bid), label=self.edge_label(block.bid, next_bid))
+
+    def edge_label(self, frm: int, to: int) -> str:
+        label = self.edge_labels.get((frm, to))
+        if label is None:
+            condition = self.edges[(frm, to)]
+            if condition:
+                segment = source_segment(self.source_lines, condition)
+                label = segment + '\n' if segment is not None else astor.to_source(condition)
+            else:
+                label = ''
+            self.edge_labels[(frm, to)] = label
+        return label
+
+    def write_dot(self, out: TextIO, calls: bool = True, prefix: str = '', depth: int = 0, nested: bool = True) -> None:
+        # Streamed function by function; nested functions become nested clusters, or are left out with
+        # nested=False. Block ids are only unique within one CFG, so nested graphs qualify their node names with
+        # the path of enclosing function names.
+        indent = '\t' * depth
+        out.write('{}{} {} {{\n'.format(indent, 'subgraph' if depth else 'digraph', DotWriter.quote('cluster_' + prefix + self.name)))
+        out.write('{}\tgraph [label={}]\n'.format(indent, DotWriter.quote(self.name)))
+        self._traverse(DotWriter(out, depth + 1), self.start, calls=calls, prefix=prefix)
+        for k, v in self.func_calls.items() if nested else ():
+            v.write_dot(out, calls, prefix + k + '.', depth + 1)
+        out.write(indent + '}\n')
+
+    def write_dot_file(self, filepath: str, calls: bool = True, compress: bool = False) -> None:
+        # gzip-compressed if asked to or if filepath ends with .gz
+        with (gzip.open(filepath, 'wt') if compress or filepath.endswith('.gz') else open(filepath, 'w')) as out:
+            self.write_dot(out, calls)
+
+    def compute_labels(self) -> None:
+        # fills the label memos of every graph up front, so label generation can be timed on its own
+        pending = [self]
+        while pending:
+            curr = pending.pop()
+            for block in curr.live_blocks():
+                block.stmts_to_code(curr.source_lines)
+                for next_bid in block.next:
+                    curr.edge_label(block.bid, next_bid)
+            pending.extend(curr.func_calls.values())
+
+    edge_kinds: Tuple[str, ...] = ('plain', 'conditional', 'else', 'break', 'exception', 'finally')
+
+    def edge_kind(self, frm: int, to: int) -> int:
+        # Conditions merged by remove_empty_blocks are And chains; the most specific part decides. Loaded CFGs
+        # only keep the condition text, so keywords are matched as words there.
+        kind = self.condition_kind(self.edges[(frm, to)])
+        if kind == 1 and any(type(stmt) == ast.Name and stmt.id == 'handle errors' for stmt in self.blocks[frm].stmts):
+            # the dispatch block of a try statement, whose conditional edges lead to the except clauses
+            return 4
+        return kind
+
+    @classmethod
+    def condition_kind(cls, condition: Optional[Type[ast.AST]]) -> int:
+        if not condition:
+            return 0
+        if type(condition) == ast.BoolOp and type(condition.op) == ast.And:
+            kinds = [cls.condition_kind(value) for value in condition.values]
+            return max(kinds, key=lambda kind: (kind != 1, kind))
+        if type(condition) == ast.Break:
+            return 3
+        if type(condition) == ast.Name:
+            if condition.id in ('else', 'No Error'):
+                return 2
+            if condition.id == 'Finally':
+                return 5
+            if 'break' in condition.id.replace('(', ' ').replace(')', ' ').split():
+                return 3
+        return 1
+
+    def to_csr(self) -> CSRGraph:
+        import numpy as np  # optional, only needed for array exports
+        graphs: List[Tuple[str, CFG]] = []
+        pending = [('', self)]
+        while pending:
+            prefix, curr = pending.pop()
+            graphs.append((prefix + curr.name, curr))
+            # reversed so nested graphs come out in the order of func_calls, as in write_dot
+            pending.extend((prefix + curr.name + '.', v) for v in reversed(list(curr.func_calls.values())))
+        indptr, indices, kinds, block_ids, graph_ptr, starts = [0], [], [], [], [0], []
+        for _, curr in graphs:
+            blocks = curr.live_blocks()
+            offset = graph_ptr[-1]
+            index = {block.bid: offset + i for i, block in enumerate(blocks)}
+            starts.append(index[curr.start.bid])
+            for block in blocks:
+                block_ids.append(block.bid)
+                for next_bid in block.next:
+                    indices.append(index[next_bid])
+                    kinds.append(curr.edge_kind(block.bid, next_bid))
+                indptr.append(len(indices))
+            graph_ptr.append(offset + len(blocks))
+        return CSRGraph(np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int32), np.array(kinds, dtype=np.int8),
+                        np.array(block_ids, dtype=np.int32), np.array(graph_ptr, dtype=np.int64), np.array(starts, dtype=np.int32),
+                        [name for name, _ in graphs])
+
+    # Dominator analyses of this graph alone, nested function CFGs have their own. Post-dominators are computed on
+    # the reversed graph from a virtual exit block, exit_id, whose predecessors are the blocks without successors;
+    # blocks that cannot reach it (inside an endless loop) have no post-dominator. Unreachable blocks are left out.
+    exit_id: int = 0
+
+    def flow(self, post: bool = False) -> Tuple[int, Dict[int, List[int]], Dict[int, List[int]]]:
+        # root, successors and predecessors of the graph the analysis runs on
+        blocks = self.live_blocks()
+        successors = {block.bid: list(block.next) for block in blocks}
+        predecessors = {block.bid: list(block.prev) for block in blocks}
+        if not post:
+            return self.start.bid, successors, predecessors
+        exits = [block.bid for block in blocks if not block.next]
+        for bid in exits:
+            successors[bid].append(self.exit_id)
+        predecessors[self.exit_id] = exits
+        successors[self.exit_id] = []
+        return self.exit_id, predecessors, successors
+
+    def immediate_dominators(self, post: bool = False) -> Dict[int, int]:
+        # block id -> id of its immediate (post-)dominator; the root (start or exit_id) maps to itself
+        key = ('idom', post)
+        if key not in self.analyses:
+            root, successors, predecessors = self.flow(post)
+            self.analyses[key] = immediate_dominators(root, successors, predecessors)
+        return self.analyses[key]
+
+    def dominates(self, a: int, b: int, post: bool = False) -> bool:
+        # a (post-)dominates b, in O(1) from the pre- and postorder numbers of the dominator tree
+        key = ('intervals', post)
+        if key not in self.analyses:
+            idom = self.immediate_dominators(post)
+            children: Dict[int, List[int]] = {node: [] for node in idom}
+            root = None
+            for node, parent in idom.items():
+                if node == parent:
+                    root = node
+                else:
+                    children[parent].append(node)
+            intervals, counter = {}, 0
+            stack = [(root, iter(children[root]))]
+            intervals[root] = [counter, None]
+            while stack:
+                node, it = stack[-1]
+                child = next(it, None)
+                counter += 1
+                if child is None:
+                    stack.pop()
+                    intervals[node][1] = counter
+                else:
+                    intervals[child] = [counter, None]
+                    stack.append((child, iter(children[child])))
+            self.analyses[key] = intervals
+        intervals = self.analyses[key]
+        if a not in intervals or b not in intervals:
+            return False
+        return intervals[a][0] <= intervals[b][0] and intervals[b][1] <= intervals[a][1]
+
+    def dominance_frontiers(self, post: bool = False) -> Dict[int, Set[int]]:
+        # with post, the post-dominance frontiers, i.e. the blocks each block is control dependent on
+        key = ('frontiers', post)
+        if key not in self.analyses:
+            _, _, predecessors = self.flow(post)
+            self.analyses[key] = dominance_frontiers(self.immediate_dominators(post), predecessors)
+        return self.analyses[key]
+
+    def dominance_frontier(self, bid: int, post: bool = False) -> Set[int]:
+        return self.dominance_frontiers(post).get(bid, set())
+
+    # Complexity metrics read off the block and edge tables only (no labels, no graphviz), for this graph alone.
+    metric_names: Tuple[str, ...] = ('blocks', 'edges', 'exits', 'components', 'cyclomatic', 'stmts', 'calls', 'branches',
+                                     'max_fan_out', 'loops', 'max_loop_depth', 'conditional_edges', 'else_edges',
+                                     'break_edges', 'exception_edges', 'finally_edges')
+
+    def loop_depths(self) -> Tuple[int, Dict[int, int]]:
+        # the number of natural loops and the number of them around every reachable block; a loop is the set of
+        # blocks that reach a back edge n -> h (h dominates n) without passing h, and loops with the same header
+        # are one loop. Only the guards of for and while loops, whose loop statement comes first even after
+        # coalesce(), are headers: the edges from the ends of the handlers of a try back to its dispatch block are
+        # back edges too, but not loops
+        idom = self.immediate_dominators()
+        latches: Dict[int, List[int]] = {}
+        for bid in idom:
+            for next_bid in self.blocks[bid].next:
+                stmts = self.blocks[next_bid].stmts
+                if stmts and type(stmts[0]) in (ast.For, ast.While) and self.dominates(next_bid, bid):
+                    latches.setdefault(next_bid, []).append(bid)
+        depths = dict.fromkeys(idom, 0)
+        for header, tails in latches.items():
+            body = {header}
+            stack = [bid for bid in tails if bid != header]
+            body.update(stack)
+            while stack:
+                for prev_bid in self.blocks[stack.pop()].prev:
+                    if prev_bid not in body and prev_bid in idom:
+                        body.add(prev_bid)
+                        stack.append(prev_bid)
+            for bid in body:
+                depths[bid] += 1
+        return len(latches), depths
+
+    def metrics(self) -> Dict[str, int]:
+        # Cyclomatic complexity is E - N + 2P over the live blocks, P the number of weakly connected components,
+        # once the blocks without successors of each component are linked to an exit block of its own.
+        blocks = self.live_blocks()
+        values = dict.fromkeys(self.metric_names, 0)
+        values['blocks'] = len(blocks)
+        seen: Set[int] = set()
+        for block in blocks:
+            fan_out = len(block.next)
+            values['edges'] += fan_out
+            values['stmts'] += len(block.stmts)
+            values['calls'] += len(block.calls)
+            values['branches'] += fan_out > 1
+            values['exits'] += fan_out == 0
+            values['max_fan_out'] = max(values['max_fan_out'], fan_out)
             for next_bid in block.next:
-                self._traverse(self.blocks[next_bid], visited, calls=calls)
-                self.graph.edge(str(block.bid), str(next_bid), label=astor.to_source(self.edges[(block.bid, next_bid)]) if self.edges[(block.bid, next_bid)] else '')
-
-    def _show(self, fmt: str = 'pdf', calls: bool = True) -> gv.dot.Digraph:
-        self.graph = gv.Digraph(name='cluster_'+self.name, format=fmt, graph_attr={'label': self.name})
-        self._traverse(self.start, calls=calls)
-        for k, v in self.func_calls.items():
-            self.graph.subgraph(v._show(fmt, calls))
-        return self.graph
-
-    def show(self, filepath: str = './output', fmt: str = 'pdf', calls: bool = True, show: bool = True) -> None:
-        self._show(fmt, calls)
-        self.graph.render(filepath, view=show, cleanup=True)
+                kind = self.edge_kind(block.bid, next_bid)
+                if kind:
+                    values[self.edge_kinds[kind] + '_edges'] += 1
+            if block.bid not in seen:
+                values['components'] += 1
+                seen.add(block.bid)
+                stack = [block]
+                while stack:
+                    curr = stack.pop()
+                    for bid in (*curr.next, *curr.prev):
+                        if bid not in seen:
+                            seen.add(bid)
+                            stack.append(self.blocks[bid])
+        values['cyclomatic'] = values['edges'] + values['exits'] - values['blocks'] + values['components']
+        values['loops'], depths = self.loop_depths()
+        values['max_loop_depth'] = max(depths.values(), default=0)
+        return values
+
+    def function_metrics(self, prefix: str = '') -> Iterator[Tuple[str, Dict[str, int]]]:
+        # (qualified name, metrics) of this graph and every nested function CFG, in the order of write_dot
+        pending = [(prefix + self.name, self)]
+        while pending:
+            name, curr = pending.pop()
+            yield name, curr.metrics()
+            pending.extend((name + '.' + k, v) for k, v in reversed(list(curr.func_calls.items())))
+
+    def stats(self) -> Dict[str, int]:
+        # counts of this graph alone, nested function CFGs are only counted as subgraphs
+        blocks = self.live_blocks()
+        return {'blocks': len(blocks), 'edges': sum(len(block.next) for block in blocks),
+                'stmts': sum(len(block.stmts) for block in blocks), 'subgraphs': len(self.func_calls)}
+
+    def show(self, filepath: str = './output', fmt: str = 'pdf', calls: bool = True, show: bool = True,
+             profiler: Optional[Profiler] = None) -> None:
+        with stage(profiler, 'dot'):
+            self.write_dot_file(filepath, calls)
+        try:
+            with stage(profiler, 'render', format=fmt):
+                rendered = gv.render('dot', fmt, filepath)
+        finally:
+            os.remove(filepath)
+        if show:
+            gv.view(rendered)
+
+    # Serialized CFGs only keep the graph structure: statements taken from the source are stored as
+    # [lineno, end_lineno] (the header lines for compound statements), synthetic ones as their code.
+    binary_magic: bytes = b'CFGB\x02'
+
+    @staticmethod
+    def stmt_to_data(stmt: Type[ast.AST]) -> Union[List[int], str]:
+        if getattr(stmt, 'lineno', None) is None:
+            return stmt_to_code(stmt).rstrip('\n')
+        if isinstance(stmt, header_stmts) and stmt.body and hasattr(stmt.body[0], 'lineno'):
+            return [stmt.lineno, max(stmt.lineno, stmt.body[0].lineno - 1)]
+        return [stmt.lineno, stmt.end_lineno or stmt.lineno]
+
+    @staticmethod
+    def data_to_stmt(data: Union[List[int], str], lines: Optional[List[str]]) -> Type[ast.AST]:
+        # Loaded statements are ast.Name placeholders whose id is the code to display.
+        if isinstance(data, str):
+            return ast.Name(id=data, ctx=ast.Load())
+        lineno, end_lineno = data
+        if lines is not None:
+            text = textwrap.dedent(''.join(lines[lineno - 1:end_lineno])).rstrip('\n')
+        else:
+            text = 'line {}'.format(lineno) if lineno == end_lineno else 'lines {}-{}'.format(lineno, end_lineno)
+        return ast.Name(id=text, ctx=ast.Load(), lineno=lineno, end_lineno=end_lineno)
+
+    def coalesce(self, compact: bool = False) -> int:
+        # Merges every block into its only predecessor when that one has no other successor and the edge between
+        # them is unconditional, or is the success edge of an assert that ends the predecessor and already shows
+        # the condition. Statements and calls are concatenated and the successors of the merged block, with their
+        # conditions, move to the block it was merged into. With compact, blocks that cannot be reached from the
+        # start, such as the ones opened after return and raise, are dropped first. Linear in the size of the
+        # graphs; nested function CFGs are simplified as well (and built). Returns the number of blocks removed.
+        removed = 0
+        pending = [self]
+        while pending:
+            curr = pending.pop()
+            removed += curr._coalesce(compact)
+            pending.extend(curr.func_calls.values())
+        return removed
+
+    def _coalesce(self, compact: bool) -> int:
+        blocks = self.blocks
+        count = len(blocks)
+        if compact:
+            reachable = {self.start.bid}
+            stack = [self.start]
+            while stack:
+                for next_bid in stack.pop().next:
+                    if next_bid not in reachable:
+                        reachable.add(next_bid)
+                        stack.append(blocks[next_bid])
+            for bid in [bid for bid in blocks if bid not in reachable]:
+                block = blocks.pop(bid)
+                for next_bid in block.next:
+                    self.edges.pop((bid, next_bid), None)
+                    self.edge_labels.pop((bid, next_bid), None)
+                    if next_bid in reachable:
+                        blocks[next_bid].remove_from_prev(bid)
+        for block in list(blocks.values()):
+            if block.bid not in blocks:
+                continue
+            while len(block.next) == 1:
+                successor = blocks[next(iter(block.next))]
+                if successor is block or successor is self.start or len(successor.prev) != 1:
+                    break
+                condition = self.edges.get((block.bid, successor.bid))
+                if condition is not None and not (block.stmts and type(block.stmts[-1]) == ast.Assert and block.stmts[-1].test is condition):
+                    break
+                self._merge(block, successor)
+        if len(blocks) != count:
+            self.analyses = {}
+        return count - len(blocks)
+
+    def _merge(self, block: BasicBlock, successor: BasicBlock) -> None:
+        bid, succ = block.bid, successor.bid
+        del self.edges[(bid, succ)]
+        self.edge_labels.pop((bid, succ), None)
+        block.code = block.code + successor.code if block.code is not None and successor.code is not None else None
+        block.stmts.extend(successor.stmts)
+        block.calls.extend(successor.calls)
+        block.next = successor.next
+        for next_bid in block.next:
+            self.edges[(bid, next_bid)] = self.edges.pop((succ, next_bid))
+            label = self.edge_labels.pop((succ, next_bid), None)
+            if label is not None:
+                self.edge_labels[(bid, next_bid)] = label
+            target = self.blocks[next_bid]
+            target.remove_from_prev(succ)
+            target.add_prev(bid)
+        del self.blocks[succ]
+
+    def live_blocks(self) -> List[BasicBlock]:
+        # blocks emptied by remove_empty_blocks stay in self.blocks but are detached from the graph
+        return [block for block in self.blocks.values() if block is self.start or block.stmts or block.prev or block.next]
+
+    def to_dict(self) -> Dict:
+        edges = []
+        blocks = []
+        for block in self.live_blocks():
+            blocks.append({'id': block.bid, 'stmts': [self.stmt_to_data(stmt) for stmt in block.stmts], 'calls': list(block.calls)})
+            for next_bid in block.next:
+                edges.append([block.bid, next_bid, self.edge_label(block.bid, next_bid).rstrip('\n') if self.edges[(block.bid, next_bid)] else None])
+        return {'name': self.name, 'start': self.start.bid, 'blocks': blocks, 'edges': edges,
+                'func_calls': {k: v.to_dict() for k, v in self.func_calls.items()}}
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+    @classmethod
+    def from_dict(cls, data: Dict, source: Optional[str] = None) -> CFG:
+        return cls._from_dict(data, split_lines(source) if source is not None else None)
+
+    @classmethod
+    def _from_dict(cls, data: Dict, lines: Optional[List[str]]) -> CFG:
+        cfg = cls(data['name'])
+        cfg.source_lines = lines
+        for block_data in data['blocks']:
+            block = BasicBlock(block_data['id'])
+            block.stmts = [cls.data_to_stmt(stmt, lines) for stmt in block_data['stmts']]
+            block.calls = list(block_data['calls'])
+            cfg.blocks[block.bid] = block
+        for frm, to, condition in data['edges']:
+            cfg.blocks[frm].add_next(to)
+            cfg.blocks[to].add_prev(frm)
+            cfg.edges[(frm, to)] = ast.Name(id=condition, ctx=ast.Load()) if condition is not None else None
+        cfg.start = cfg.blocks[data['start']]
+        cfg.func_calls = FuncCalls({k: cls._from_dict(v, lines) for k, v in data['func_calls'].items()})
+        return cfg
+
+    # In-memory transfer format of the parallel build: the whole CFG with its labels, as tuples and lists that
+    # pickle compactly, unlike to_dict it keeps the statement and condition nodes themselves.
+    def pack(self) -> Tuple:
+        blocks = [(b.bid, b.stmts, b.calls, list(b.prev), list(b.next), b.code) for b in self.blocks.values()]
+        edges = [(frm, to, condition, self.edge_labels.get((frm, to))) for (frm, to), condition in self.edges.items()]
+        return (self.name, self.start.bid, blocks, edges, [(k, v.pack()) for k, v in self.func_calls.items()])
+
+    @classmethod
+    def unpack(cls, data: Tuple, lines: Optional[List[str]]) -> CFG:
+        name, start, blocks, edges, func_calls = data
+        cfg = cls(name)
+        cfg.source_lines = lines
+        for bid, stmts, calls, prev, next_, code in blocks:
+            block = BasicBlock(bid)
+            block.stmts, block.calls, block.code = stmts, calls, code
+            for prev_bid in prev:
+                block.add_prev(prev_bid)
+            for next_bid in next_:
+                block.add_next(next_bid)
+            cfg.blocks[bid] = block
+        cfg.start = cfg.blocks[start]
+        for frm, to, condition, label in edges:
+            cfg.edges[(frm, to)] = condition
+            if label is not None:
+                cfg.edge_labels[(frm, to)] = label
+        cfg.func_calls = FuncCalls({k: cls.unpack(v, lines) for k, v in func_calls})
+        return cfg
+
+    @classmethod
+    def from_json(cls, text: str, source: Optional[str] = None) -> CFG:
+        return cls.from_dict(json.loads(text), source)
+
+    def to_bytes(self) -> bytes:
+        writer = BinaryWriter()
+        writer.out += self.binary_magic
+        self._write(writer, self.to_dict())
+        return bytes(writer.out)
+
+    @classmethod
+    def _write(cls, writer: BinaryWriter, data: Dict) -> None:
+        # stmt tags: 0 = code string, 1 = line range; call and edge condition tags: 0 = none, 1 = string
+        writer.string(data['name'])
+        writer.varint(data['start'])
+        writer.varint(len(data['blocks']))
+        for block in data['blocks']:
+            writer.varint(block['id'])
+            writer.varint(len(block['stmts']))
+            for stmt in block['stmts']:
+                if isinstance(stmt, str):
+                    writer.varint(0)
+                    writer.string(stmt)
+                else:
+                    writer.varint(1)
+                    writer.varint(stmt[0])
+                    writer.varint(stmt[1] - stmt[0])
+            writer.varint(len(block['calls']))
+            for call in block['calls']:
+                if call is None:
+                    writer.varint(0)
+                else:
+                    writer.varint(1)
+                    writer.string(call)
+        writer.varint(len(data['edges']))
+        for frm, to, condition in data['edges']:
+            writer.varint(frm)
+            writer.varint(to)
+            if condition is None:
+                writer.varint(0)
+            else:
+                writer.varint(1)
+                writer.string(condition)
+        writer.varint(len(data['func_calls']))
+        for name, sub in data['func_calls'].items():
+            writer.string(name)
+            cls._write(writer, sub)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, source: Optional[str] = None) -> CFG:
+        if not data.startswith(cls.binary_magic):
+            raise ValueError('not a binary CFG')
+        return cls.from_dict(cls._read(BinaryReader(data, len(cls.binary_magic))), source)
+
+    @classmethod
+    def _read(cls, reader: BinaryReader) -> Dict:
+        name = reader.string()
+        start = reader.varint()
+        blocks = []
+        for _ in range(reader.varint()):
+            bid = reader.varint()
+            stmts = []
+            for _ in range(reader.varint()):
+                if reader.varint():
+                    lineno = reader.varint()
+                    stmts.append([lineno, lineno + reader.varint()])
+                else:
+                    stmts.append(reader.string())
+            calls = [reader.string() if reader.varint() else None for _ in range(reader.varint())]
+            blocks.append({'id': bid, 'stmts': stmts, 'calls': calls})
+        edges = []
+        for _ in range(reader.varint()):
+            frm = reader.varint()
+            to = reader.varint()
+            edges.append([frm, to, reader.string() if reader.varint() else None])
+        func_calls = {}
+        for _ in range(reader.varint()):
+            sub_name = reader.string()
+            func_calls[sub_name] = cls._read(reader)
+        return {'name': name, 'start': start, 'blocks': blocks, 'edges': edges, 'func_calls': func_calls}
+
+    def save(self, filepath: str, emit: str = 'graph', fmt: str = 'pdf', show: bool = True,
+             profiler: Optional[Profiler] = None, jobs: Optional[int] = None) -> None:
+        # emit is one of 'graph' (render with graphviz), 'shards' (render every function into the directory
+        # filepath on jobs threads, see render.render_sharded), 'dot', 'dot.gz', 'json' or 'binary'
+        if profiler is not None:
+            with profiler.stage('labels'):
+                self.compute_labels()
+        if emit in ('dot', 'dot.gz'):
+            with stage(profiler, 'dot'):
+                self.write_dot_file(filepath + '.' + emit)
+        elif emit == 'json':
+            with stage(profiler, 'json'), open(filepath + '.json', 'w') as f:
+                json.dump(self.to_dict(), f)
+        elif emit == 'binary':
+            with stage(profiler, 'binary'), open(filepath + '.cfgb', 'wb') as f:
+                f.write(self.to_bytes())
+        elif emit == 'shards':
+            import render
+            with stage(profiler, 'render', format=fmt):
+                failed = [result for result in render.render_sharded(self, filepath, fmt, jobs) if result.error]
+            if failed:
+                raise render.RenderError(failed[0].filepath, '{} of the function graphs failed: {}'.format(len(failed), failed[0].error))
+        else:
+            self.show(filepath, fmt, show=show, profiler=profiler)
 
 
 class CFGVisitor(ast.NodeVisitor):
@@ -109,22 +998,42 @@ class CFGVisitor(ast.NodeVisitor):
                                                                ast.Gt: ast.LtE, ast.GtE: ast.Lt, ast.Is: ast.IsNot,
                                                                ast.IsNot: ast.Is, ast.In: ast.NotIn, ast.NotIn: ast.In}
 
-    def __init__(self):
+    def __init__(self, profiler: Optional[Profiler] = None, jobs: int = 1):
         super().__init__()
         self.loop_stack: List[BasicBlock] = []
+        # (assigned name or None, node) of the comprehensions being expanded, innermost last
+        self.comprehensions: List[Tuple[Optional[str], Type[ast.AST]]] = []
         self.ifExp = False
+        self.lambdaReg: Optional[Tuple[str, Type[ast.AST]]] = None
+        self.profiler: Optional[Profiler] = profiler
+        # function CFGs are built when first looked up, or with jobs > 1 all at once on a pool of jobs processes
+        self.jobs: int = jobs
 
-    def build(self, name: str, tree: Type[ast.AST]) -> CFG:
+    def build(self, name: str, tree: Type[ast.AST], source_lines: Optional[List[str]] = None) -> CFG:
+        # source_lines are the lines tree was parsed from; labels are sliced from them instead of unparsed
         self.cfg = CFG(name)
+        self.cfg.source_lines = source_lines
+        self.block_id = BlockId()
         self.curr_block = self.new_block()
         self.cfg.start = self.curr_block
 
-        self.visit(tree)
-        self.remove_empty_blocks(self.cfg.start)
+        with stage(self.profiler, 'build', name=name):
+            if type(tree) == ast.GeneratorExp:
+                # the function a generator expression stands for, see visit_GeneratorExp
+                self.comprehensions.append((None, tree))
+                self.add_comprehension(tree.generators, [tree.elt], ast.Expr(value=ast.Yield(value=tree.elt)))
+                self.comprehensions.pop()
+            else:
+                self.visit(tree)
+            with stage(self.profiler, 'remove_empty_blocks'):
+                self.remove_empty_blocks(self.cfg.start)
+        if self.jobs > 1 and self.cfg.func_calls.pending:
+            with stage(self.profiler, 'subgraphs', functions=len(self.cfg.func_calls.pending)):
+                self.cfg.func_calls.build_all(self.jobs)
         return self.cfg
 
     def new_block(self) -> BasicBlock:
-        bid: int = BlockId().gen()
+        bid: int = self.block_id.gen()
         self.cfg.blocks[bid] = BasicBlock(bid)
         return self.cfg.blocks[bid]
 
@@ -132,8 +1041,8 @@ class CFGVisitor(ast.NodeVisitor):
         block.stmts.append(stmt)
 
     def add_edge(self, frm_id: int, to_id: int, condition=None) -> BasicBlock:
-        self.cfg.blocks[frm_id].next.append(to_id)
-        self.cfg.blocks[to_id].prev.append(frm_id)
+        self.cfg.blocks[frm_id].add_next(to_id)
+        self.cfg.blocks[to_id].add_prev(frm_id)
         self.cfg.edges[(frm_id, to_id)] = condition
         return self.cfg.blocks[to_id]
 
@@ -146,7 +1055,49 @@ class CFGVisitor(ast.NodeVisitor):
             return loop_block
 
     def add_subgraph(self, tree: Type[ast.AST]) -> None:
-        self.cfg.func_calls[tree.name] = CFGVisitor().build(tree.name, ast.Module(body=tree.body))
+        self.cfg.func_calls.defer(tree.name, tree, self.cfg.source_lines, self.profiler)
+
+    def enter_comprehension(self, node: Type[ast.AST]) -> bool:
+        # Whether node is expanded: it was pushed by visit_Assign or visit_Expr, or it is nested in the element of
+        # a comprehension being expanded and gets a frame without a name here. The frame is popped once the
+        # comprehension is emitted; other comprehensions are not expanded.
+        if self.comprehensions and self.comprehensions[-1][1] is not node:
+            self.comprehensions.append((None, node))
+        return bool(self.comprehensions)
+
+    def add_comprehension(self, generators: List[ast.comprehension], values: List[Type[ast.AST]], element: Type[ast.AST],
+                          call: Optional[str] = None) -> None:
+        # Emits the blocks visit_For and visit_If add for the loops a comprehension stands for, without building
+        # those statements: one loop per generator, the last one outermost, whose conditions are tested in the loop
+        # body. The innermost body visits values, the expressions an element is computed from, so that their calls
+        # and nested comprehensions end up there, then adds the statement element storing it, which makes the call
+        # named call or yields. No loop is pushed on loop_stack, nothing in a comprehension can break out of it.
+        exits: List[Tuple[int, BasicBlock]] = []
+        for generator in reversed(generators):
+            loop_guard = self.add_loop_block()
+            self.add_stmt(loop_guard, ast.For(target=generator.target, iter=generator.iter, body=[], orelse=[]))
+            self.curr_block = self.add_edge(loop_guard.bid, self.new_block().bid)
+            exits.append((loop_guard.bid, self.add_edge(loop_guard.bid, self.new_block().bid)))
+            if generator.ifs:
+                test = self.combine_conditions(generator.ifs)
+                self.add_stmt(self.curr_block, ast.If(test=test, body=[], orelse=[]))
+                afterif_block = self.new_block()
+                filter_block = self.add_edge(self.curr_block.bid, self.new_block().bid, test)
+                self.add_edge(self.curr_block.bid, afterif_block.bid, self.invert(test))
+                exits.append((afterif_block.bid, afterif_block))
+                self.curr_block = filter_block
+        for value in values:
+            self.visit(value)
+        self.add_stmt(self.curr_block, element)
+        if call is not None:
+            self.curr_block.calls.append(call)
+        if type(element) == ast.Expr and type(element.value) == ast.Yield:
+            self.visit_Yield(element.value)
+        # the end of every body jumps back to its loop guard, or past the conditions to the rest of the loop body
+        for to_bid, after_block in reversed(exits):
+            if not self.curr_block.next:
+                self.add_edge(self.curr_block.bid, to_bid)
+            self.curr_block = after_block
 
     def add_condition(self, cond1: Optional[Type[ast.AST]], cond2: Optional[Type[ast.AST]]) -> Optional[Type[ast.AST]]:
         if cond1 and cond2:
@@ -155,27 +1106,43 @@ class CFGVisitor(ast.NodeVisitor):
             return cond1 if cond1 else cond2
 
     # not tested
-    def remove_empty_blocks(self, block: BasicBlock, visited: Set[int] = set()) -> None:
-        if block.bid not in visited:
-            visited.add(block.bid)
-            if block.is_empty():
-                for prev_bid in block.prev:
-                    prev_block = self.cfg.blocks[prev_bid]
-                    for next_bid in block.next:
-                        next_block = self.cfg.blocks[next_bid]
-                        self.add_edge(prev_bid, next_bid, self.add_condition(self.cfg.edges.get((prev_bid, block.bid)), self.cfg.edges.get((block.bid, next_bid))))
-                        self.cfg.edges.pop((block.bid, next_bid), None)
-                        next_block.remove_from_prev(block.bid)
-                    self.cfg.edges.pop((prev_bid, block.bid), None)
-                    prev_block.remove_from_next(block.bid)
-                block.prev.clear()
-                for next_bid in block.next:
-                    self.remove_empty_blocks(self.cfg.blocks[next_bid], visited)
-                block.next.clear()
-
-            else:
-                for next_bid in block.next:
-                    self.remove_empty_blocks(self.cfg.blocks[next_bid], visited)
+    # Worklist version of the recursive walk, safe for graphs with any number of blocks. The rewiring changes the
+    # successor sets being walked, so every frame walks a snapshot of them; once it is used up, successors added
+    # in the meantime are walked as well, as the loops over the old successor lists did.
+    def remove_empty_blocks(self, block: BasicBlock, visited: Optional[Set[int]] = None) -> None:
+        visited = set() if visited is None else visited
+        if block.bid in visited:
+            return
+        stack: List[List] = [self.enter_block(block, visited)]
+        while stack:
+            frame = stack[-1]
+            curr, successors = frame
+            next_bid = next(successors, None)
+            if next_bid is None:
+                pending = [bid for bid in curr.next if bid not in visited]
+                if pending:
+                    frame[1] = iter(pending)
+                    continue
+                stack.pop()
+                if curr.is_empty():
+                    curr.next.clear()
+            elif next_bid not in visited and next_bid in curr.next:
+                stack.append(self.enter_block(self.cfg.blocks[next_bid], visited))
+
+    def enter_block(self, block: BasicBlock, visited: Set[int]) -> List:
+        visited.add(block.bid)
+        if block.is_empty():
+            for prev_bid in list(block.prev):
+                prev_block = self.cfg.blocks[prev_bid]
+                for next_bid in list(block.next):
+                    next_block = self.cfg.blocks[next_bid]
+                    self.add_edge(prev_bid, next_bid, self.add_condition(self.cfg.edges.get((prev_bid, block.bid)), self.cfg.edges.get((block.bid, next_bid))))
+                    self.cfg.edges.pop((block.bid, next_bid), None)
+                    next_block.remove_from_prev(block.bid)
+                self.cfg.edges.pop((prev_bid, block.bid), None)
+                prev_block.remove_from_next(block.bid)
+            block.prev.clear()
+        return [block, iter(list(block.next))]
 
     def invert(self, node: Type[ast.AST]) -> Type[ast.AST]:
         if type(node) == ast.Compare:
@@ -231,17 +1198,21 @@ class CFGVisitor(ast.NodeVisitor):
             self.add_stmt(self.curr_block, node)
         super().generic_visit(node)
 
-    def get_function_name(self, node: Type[ast.AST]) -> str:
+    def get_function_name(self, node: Type[ast.AST]) -> Optional[str]:
+        # None for a call whose receiver is not a chain of names and attributes, like ''.join or a.b[0]()
         if type(node) == ast.Name:
             return node.id
         elif type(node) == ast.Attribute:
-            return self.get_function_name(node.value) + '.' + node.attr
-        elif type(node) == ast.Str:
-            return node.s
+            name = self.get_function_name(node.value)
+            return name + '.' + node.attr if name is not None else None
         elif type(node) == ast.Subscript:
-            return node.value.id
+            return node.value.id if type(node.value) == ast.Name else None
         elif type(node) == ast.Lambda:
             return 'lambda function'
+        elif type(node) == ast.Call:
+            name = self.get_function_name(node.func)
+            return name + '()' if name is not None else None
+        return None
 
     def populate_body(self, body_list: List[Type[ast.AST]], to_bid: int) -> None:
         for child in body_list:
@@ -260,22 +1231,24 @@ class CFGVisitor(ast.NodeVisitor):
         self.curr_block = self.add_edge(self.curr_block.bid, self.new_block().bid, node.test)
         self.generic_visit(node)
 
-    # TODO: change all those registers to stacks!
+    # TODO: change lambdaReg to a stack as well
     def visit_Assign(self, node):
         if type(node.value) in [ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.Lambda] and len(node.targets) == 1 and type(node.targets[0]) == ast.Name: # is this entire statement necessary?
             if type(node.value) == ast.ListComp:
                 self.add_stmt(self.curr_block, ast.Assign(targets=[ast.Name(id=node.targets[0].id, ctx=ast.Store())], value=ast.List(elts=[], ctx=ast.Load())))
-                self.listCompReg = (node.targets[0].id, node.value)
+                self.comprehensions.append((node.targets[0].id, node.value))
             elif type(node.value) == ast.SetComp:
                 self.add_stmt(self.curr_block, ast.Assign(targets=[ast.Name(id=node.targets[0].id, ctx=ast.Store())], value=ast.Call(func=ast.Name(id='set', ctx=ast.Load()), args=[], keywords=[])))
-                self.setCompReg = (node.targets[0].id, node.value)
+                self.comprehensions.append((node.targets[0].id, node.value))
             elif type(node.value) == ast.DictComp:
                 self.add_stmt(self.curr_block, ast.Assign(targets=[ast.Name(id=node.targets[0].id, ctx=ast.Store())], value=ast.Dict(keys=[], values=[])))
-                self.dictCompReg = (node.targets[0].id, node.value)
+                self.comprehensions.append((node.targets[0].id, node.value))
             elif type(node.value) == ast.GeneratorExp:
                 self.add_stmt(self.curr_block, ast.Assign(targets=[ast.Name(id=node.targets[0].id, ctx=ast.Store())], value=ast.Call(func=ast.Name(id='__' + node.targets[0].id + 'Generator__', ctx=ast.Load()), args=[], keywords=[])))
-                self.genExpReg = (node.targets[0].id, node.value)
+                self.comprehensions.append((node.targets[0].id, node.value))
             else:
+                # keep the assignment itself, which autopep8 used to rewrite into a def statement
+                self.add_stmt(self.curr_block, node)
                 self.lambdaReg = (node.targets[0].id, node.value)
         else:
             self.add_stmt(self.curr_block, node)
@@ -301,27 +1274,20 @@ class CFGVisitor(ast.NodeVisitor):
     def visit_Continue(self, node):
         pass
 
-    def visit_DictComp_Rec(self, generators: List[Type[ast.AST]]) -> List[Type[ast.AST]]:
-        if not generators:
-            if self.dictCompReg[0]: # bug if there is else statement in comprehension
-                return [ast.Assign(targets=[ast.Subscript(value=ast.Name(id=self.dictCompReg[0], ctx=ast.Load()), slice=ast.Index(value=self.dictCompReg[1].key), ctx=ast.Store())], value=self.dictCompReg[1].value)]
-            # else: # not supported yet
-            #     return [ast.Expr(value=self.dictCompReg[1].elt)]
-        else:
-            return [ast.For(target=generators[-1].target, iter=generators[-1].iter, body=[ast.If(test=self.combine_conditions(generators[-1].ifs), body=self.visit_DictComp_Rec(generators[:-1]), orelse=[])] if generators[-1].ifs else self.visit_DictComp_Rec(generators[:-1]), orelse=[])]
-
     def visit_DictComp(self, node):
-        try: # try may change to checking if self.dictCompReg exists
-            self.generic_visit(ast.Module(self.visit_DictComp_Rec(self.dictCompReg[1].generators)))
-        except:
-            pass
-        finally:
-            self.dictCompReg = None
+        if self.enter_comprehension(node):
+            name = self.comprehensions[-1][0]
+            if name:
+                element = ast.Assign(targets=[ast.Subscript(value=ast.Name(id=name, ctx=ast.Load()), slice=node.key, ctx=ast.Store())], value=node.value)
+            else:
+                element = ast.Expr(value=ast.Tuple(elts=[node.key, node.value], ctx=ast.Load()))
+            self.add_comprehension(node.generators, [node.key, node.value], element)
+            self.comprehensions.pop()
 
     # ignore the case when using set or dict comprehension or generator expression but the result is not assigned to a variable
     def visit_Expr(self, node):
         if type(node.value) == ast.ListComp and type(node.value.elt) == ast.Call:
-            self.listCompReg = (None, node.value)
+            self.comprehensions.append((None, node.value))
         elif type(node.value) == ast.Lambda:
             self.lambdaReg = ('Anonymous Function', node.value)
         # elif type(node.value) == ast.Call and type(node.value.func) == ast.Lambda:
@@ -360,24 +1326,15 @@ class CFGVisitor(ast.NodeVisitor):
         # Continue building the CFG in the after-for block.
         self.curr_block = afterfor_block        
 
-    def visit_GeneratorExp_Rec(self, generators: List[Type[ast.AST]]) -> List[Type[ast.AST]]:
-        if not generators:
-            self.generic_visit(self.genExpReg[1].elt) # the location of the node may be wrong
-            if self.genExpReg[0]: # bug if there is else statement in comprehension
-                return [ast.Expr(value=ast.Yield(value=self.genExpReg[1].elt))]
-        else:
-            return [ast.For(target=generators[-1].target, iter=generators[-1].iter, body=[ast.If(test=self.combine_conditions(generators[-1].ifs), body=self.visit_GeneratorExp_Rec(generators[:-1]), orelse=[])] if generators[-1].ifs else self.visit_GeneratorExp_Rec(generators[:-1]), orelse=[])]
-
     def visit_GeneratorExp(self, node):
-        try: # try may change to checking if self.genExpReg exists
-            self.generic_visit(ast.FunctionDef(name='__' + self.genExpReg[0] + 'Generator__', 
-                args=ast.arguments(args=[], vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[]),
-                body = self.visit_GeneratorExp_Rec(self.genExpReg[1].generators), 
-                decorator_list=[], returns=None))
-        except:
-            pass
-        finally:
-            self.genExpReg = None
+        # one nested in the element of a comprehension only runs once iterated, it is not expanded
+        if self.comprehensions and self.comprehensions[-1][1] is node:
+            name = self.comprehensions.pop()[0]
+            tree = ast.FunctionDef(name='__' + name + 'Generator__', args=ast.arguments(args=[], vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[]),
+                                   body=[], decorator_list=[], returns=None)
+            self.add_stmt(self.curr_block, tree)
+            # built right away, there is no function body to build it from later
+            self.cfg.func_calls.adopt(tree.name, CFGVisitor(self.profiler).build(tree.name, node, self.cfg.source_lines), tree)
 
     def visit_If(self, node):
         # Add the If statement at the end of the current block.
@@ -413,26 +1370,20 @@ class CFGVisitor(ast.NodeVisitor):
             self.generic_visit(ast.Module(self.visit_IfExp_Rec(node)))
 
     def visit_Lambda(self, node): # deprecated since there is autopep8
+        if self.lambdaReg is None:
+            # not assigned or called right away, e.g. inside a comprehension
+            return
         self.add_subgraph(ast.FunctionDef(name=self.lambdaReg[0], args=node.args, body = [ast.Return(value=node.body)], decorator_list=[], returns=None))
         self.lambdaReg = None
 
-    def visit_ListComp_Rec(self, generators: List[Type[ast.AST]]) -> List[Type[ast.AST]]:
-        if not generators:
-            self.generic_visit(self.listCompReg[1].elt) # the location of the node may be wrong
-            if self.listCompReg[0]: # bug if there is else statement in comprehension
-                return [ast.Expr(value=ast.Call(func=ast.Attribute(value=ast.Name(id=self.listCompReg[0], ctx=ast.Load()), attr='append', ctx=ast.Load()), args=[self.listCompReg[1].elt], keywords=[]))]
-            else:
-                return [ast.Expr(value=self.listCompReg[1].elt)]
-        else:
-            return [ast.For(target=generators[-1].target, iter=generators[-1].iter, body=[ast.If(test=self.combine_conditions(generators[-1].ifs), body=self.visit_ListComp_Rec(generators[:-1]), orelse=[])] if generators[-1].ifs else self.visit_ListComp_Rec(generators[:-1]), orelse=[])]
-
     def visit_ListComp(self, node):
-        try: # try may change to checking if self.listCompReg exists
-            self.generic_visit(ast.Module(self.visit_ListComp_Rec(self.listCompReg[1].generators)))
-        except:
-            pass
-        finally:
-            self.listCompReg = None
+        if self.enter_comprehension(node):
+            name = self.comprehensions[-1][0]
+            if name: # bug if there is else statement in comprehension
+                self.add_comprehension(node.generators, [node.elt], ast.Expr(value=ast.Call(func=ast.Attribute(value=ast.Name(id=name, ctx=ast.Load()), attr='append', ctx=ast.Load()), args=[node.elt], keywords=[])), name + '.append')
+            else:
+                self.add_comprehension(node.generators, [node.elt], ast.Expr(value=node.elt))
+            self.comprehensions.pop()
 
     def visit_Pass(self, node):
         self.add_stmt(self.curr_block, node)
@@ -454,23 +1405,14 @@ class CFGVisitor(ast.NodeVisitor):
         # the return statement will not be included in the CFG.
         self.curr_block = self.new_block()
 
-    def visit_SetComp_Rec(self, generators: List[Type[ast.AST]]) -> List[Type[ast.AST]]:
-        if not generators:
-            self.generic_visit(self.setCompReg[1].elt) # the location of the node may be wrong
-            if self.setCompReg[0]:
-                return [ast.Expr(value=ast.Call(func=ast.Attribute(value=ast.Name(id=self.setCompReg[0], ctx=ast.Load()), attr='add', ctx=ast.Load()), args=[self.setCompReg[1].elt], keywords=[]))]
-            else: # not supported yet
-                return [ast.Expr(value=self.setCompReg[1].elt)]
-        else:
-            return [ast.For(target=generators[-1].target, iter=generators[-1].iter, body=[ast.If(test=self.combine_conditions(generators[-1].ifs), body=self.visit_SetComp_Rec(generators[:-1]), orelse=[])] if generators[-1].ifs else self.visit_SetComp_Rec(generators[:-1]), orelse=[])]
-
     def visit_SetComp(self, node):
-        try: # try may change to checking if self.setCompReg exists
-            self.generic_visit(ast.Module(self.visit_SetComp_Rec(self.setCompReg[1].generators)))
-        except:
-            pass
-        finally:
-            self.setCompReg = None
+        if self.enter_comprehension(node):
+            name = self.comprehensions[-1][0]
+            if name:
+                self.add_comprehension(node.generators, [node.elt], ast.Expr(value=ast.Call(func=ast.Attribute(value=ast.Name(id=name, ctx=ast.Load()), attr='add', ctx=ast.Load()), args=[node.elt], keywords=[])), name + '.add')
+            else:
+                self.add_comprehension(node.generators, [node.elt], ast.Expr(value=node.elt))
+            self.comprehensions.pop()
 
     def visit_Try(self, node):
         loop_guard = self.add_loop_block()
@@ -556,72 +1498,335 @@ class CFGVisitor(ast.NodeVisitor):
 
 class PyParser:
 
-    def __init__(self, script):
+    def __init__(self, script, filename: str = '<unknown>'):
         self.script = script
+        self.filename: str = filename
 
     def formatCode(self):
+        import autopep8  # only needed for the opt-in reformatting stage
         self.script = autopep8.fix_code(self.script)
 
-    # https://github.com/liftoff/pyminifier/blob/master/pyminifier/minification.py
-    def removeCommentsAndDocstrings(self):
-        io_obj = io.StringIO(self.script)  # ByteIO for Python2?
-        out = ""
-        prev_toktype = tokenize.INDENT
-        last_lineno = -1
-        last_col = 0
-        for tok in tokenize.generate_tokens(io_obj.readline):
-            token_type = tok[0]
-            token_string = tok[1]
-            start_line, start_col = tok[2]
-            end_line, end_col = tok[3]
-            if start_line > last_lineno:
-                last_col = 0
-            if start_col > last_col:
-                out += (" " * (start_col - last_col))
-            # Remove comments:
-            if token_type == tokenize.COMMENT:
-                pass
-            # This series of conditionals removes docstrings:
-            elif token_type == tokenize.STRING:
-                if prev_toktype != tokenize.INDENT:
-                    # This is likely a docstring; double-check we're not inside an operator:
-                    if prev_toktype != tokenize.NEWLINE:
-                        # Note regarding NEWLINE vs NL: The tokenize module
-                        # differentiates between newlines that start a new statement
-                        # and newlines inside of operators such as parens, brackes,
-                        # and curly braces.  Newlines inside of operators are
-                        # NEWLINE and newlines that start new code are NL.
-                        # Catch whole-module docstrings:
-                        if start_col > 0:
-                            # Unlabelled indentation means we're inside an operator
-                            out += token_string
-                        # Note regarding the INDENT token: The tokenize module does
-                        # not label indentation inside of an operator (parens,
-                        # brackets, and curly braces) as actual indentation.
-                        # For example:
-                        # def foo():
-                        #     "The spaces before this docstring are tokenize.INDENT"
-                        #     test = [
-                        #         "The spaces before this string do not get a token"
-                        #     ]
-            else:
-                out += token_string
-            prev_toktype = token_type
-            last_col = end_col
-            last_lineno = end_line
-        self.script = out
+    def parse(self) -> ast.Module:
+        return ast.parse(self.script, self.filename)
+
+    # AST counterpart of removeCommentsAndDocstrings: drops string expression statements in place without
+    # rewriting the source, so line numbers are unchanged. Comments never reach the AST anyway.
+    # Only statements can hold statements, so expressions are never walked.
+    def removeDocstrings(self, tree: ast.Module) -> ast.Module:
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            for field in ('body', 'orelse', 'finalbody', 'handlers', 'cases'):
+                stmts = getattr(node, field, None)
+                if not isinstance(stmts, list):
+                    continue
+                if any(self.is_docstring(stmt) for stmt in stmts):
+                    stmts = [stmt for stmt in stmts if not self.is_docstring(stmt)]
+                    setattr(node, field, stmts)
+                stack.extend(stmts)
+        return tree
+
+    @staticmethod
+    def is_docstring(stmt: Type[ast.AST]) -> bool:
+        return type(stmt) == ast.Expr and type(stmt.value) == ast.Constant and type(stmt.value.value) == str
 
-if __name__ == '__main__':
-    filename = sys.argv[1]
+    def removeCommentsAndDocstrings(self):
+        self.script = ''.join(strip_comments_and_docstrings(io.StringIO(self.script)))
+
+
+# https://github.com/liftoff/pyminifier/blob/master/pyminifier/minification.py
+# Streams the stripped source as string pieces, so a file object can be processed without holding intermediate
+# copies of the whole source; join the pieces (or write them out) to get the result in linear time.
+def strip_comments_and_docstrings(file: TextIO) -> Iterator[str]:
+    prev_toktype = tokenize.INDENT
+    last_lineno = -1
+    last_col = 0
+    for tok in tokenize.generate_tokens(file.readline):
+        token_type = tok[0]
+        token_string = tok[1]
+        start_line, start_col = tok[2]
+        end_line, end_col = tok[3]
+        if start_line > last_lineno:
+            last_col = 0
+        if start_col > last_col:
+            yield " " * (start_col - last_col)
+        # Remove comments:
+        if token_type == tokenize.COMMENT:
+            pass
+        # This series of conditionals removes docstrings:
+        elif token_type == tokenize.STRING:
+            if prev_toktype != tokenize.INDENT:
+                # This is likely a docstring; double-check we're not inside an operator:
+                if prev_toktype != tokenize.NEWLINE:
+                    # Note regarding NEWLINE vs NL: The tokenize module
+                    # differentiates between newlines that start a new statement
+                    # and newlines inside of operators such as parens, brackes,
+                    # and curly braces.  Newlines inside of operators are
+                    # NEWLINE and newlines that start new code are NL.
+                    # Catch whole-module docstrings:
+                    if start_col > 0:
+                        # Unlabelled indentation means we're inside an operator
+                        yield token_string
+                    # Note regarding the INDENT token: The tokenize module does
+                    # not label indentation inside of an operator (parens,
+                    # brackets, and curly braces) as actual indentation.
+                    # For example:
+                    # def foo():
+                    #     "The spaces before this docstring are tokenize.INDENT"
+                    #     test = [
+                    #         "The spaces before this string do not get a token"
+                    #     ]
+        else:
+            yield token_string
+        prev_toktype = token_type
+        last_col = end_col
+        last_lineno = end_line
+
+
+# set by FuncCalls.build_all while its pool of forked workers runs
+subgraph_functions: List[Tuple[str, Type[ast.AST], Optional[List[str]]]] = []
+
+
+def node_paths(tree: Type[ast.AST]) -> Dict[int, Tuple[Union[str, int], ...]]:
+    # id of every node below tree -> its path of field names and list indices from tree
+    paths = {id(tree): ()}
+    stack = [(tree, ())]
+    while stack:
+        node, path = stack.pop()
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, ast.AST):
+                paths[id(value)] = path + (field,)
+                stack.append((value, path + (field,)))
+            elif isinstance(value, list):
+                for i, item in enumerate(value):
+                    if isinstance(item, ast.AST):
+                        paths[id(item)] = path + (field, i)
+                        stack.append((item, path + (field, i)))
+    return paths
+
+
+class SubgraphPickler(pickle.Pickler):
+
+    def __init__(self, file: io.BytesIO, paths: Dict[int, Tuple[Union[str, int], ...]], lines: Optional[List[str]]):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.paths: Dict[int, Tuple[Union[str, int], ...]] = paths
+        self.lines: Optional[List[str]] = lines
+
+    def persistent_id(self, obj: Any) -> Optional[Union[Tuple[Union[str, int], ...], str]]:
+        if obj is self.lines and obj is not None:
+            return 'lines'
+        return self.paths.get(id(obj)) if isinstance(obj, ast.AST) else None
+
+
+class SubgraphUnpickler(pickle.Unpickler):
+
+    def __init__(self, file: io.BytesIO, tree: Type[ast.AST], lines: Optional[List[str]]):
+        super().__init__(file)
+        self.tree: Type[ast.AST] = tree
+        self.lines: Optional[List[str]] = lines
+
+    def persistent_load(self, pid: Union[Tuple[Union[str, int], ...], str]) -> Any:
+        if pid == 'lines':
+            return self.lines
+        node = self.tree
+        for step in pid:
+            node = node[step] if type(step) == int else getattr(node, step)
+        return node
+
+
+def build_subgraph(index: int) -> bytes:
+    name, tree, lines = subgraph_functions[index]
+    # taken before the build, in case the visitor changes the tree
+    paths = node_paths(tree)
+    cfg = CFGVisitor().build(name, ast.Module(body=tree.body), lines)
+    cfg.compute_labels()
+    out = io.BytesIO()
+    SubgraphPickler(out, paths, lines).dump(cfg.pack())
+    return out.getvalue()
+
+
+def build_from_source(source: str, name: str, reformat: bool = False, strict: bool = False,
+                      profiler: Optional[Profiler] = None, jobs: int = 1) -> CFG:
+    # The source is tokenized and parsed exactly once and that tree goes straight to the visitor; syntax errors
+    # surface as SyntaxError from the parse. strict additionally compiles the same tree (no re-parse) to catch
+    # errors that only the compiler reports, such as 'return' outside a function.
+    # By default the CFG is built from the original source, so line numbers point at the user's file.
+    # reformat runs the comment stripper and autopep8 first; line numbers then refer to parser.script.
+    # A profiler, if given, times every stage. With jobs > 1, the CFGs of the functions of the module are built
+    # on a pool of jobs processes (the functions nested in them are built by the same worker).
+    parser = PyParser(source, name)
+    if reformat:
+        with stage(profiler, 'strip'):
+            parser.removeCommentsAndDocstrings()
+        with stage(profiler, 'format'):
+            parser.formatCode()
+    with stage(profiler, 'parse'):
+        tree = parser.parse()
+    if strict:
+        with stage(profiler, 'compile'):
+            compile(tree, name, 'exec')
+    if not reformat:
+        with stage(profiler, 'docstrings'):
+            tree = parser.removeDocstrings(tree)
+    return CFGVisitor(profiler, jobs).build(name, tree, split_lines(parser.script))
+
+
+class Rebuild(NamedTuple):
+    cfg: CFG
+    rebuilt: List[str]
+    reused: List[str]
+
+
+def fingerprint(tree: Type[ast.AST], lines: Optional[List[str]]) -> Optional[str]:
+    # hash of the source lines of the body of a function without trailing whitespace; equal fingerprints mean
+    # equal CFGs whose statements only differ in their line numbers. None if the body has no known position.
+    body = tree.body
+    if lines is None or not body or getattr(body[0], 'lineno', None) is None or getattr(body[-1], 'end_lineno', None) is None:
+        return None
+    text = '\n'.join(line.rstrip() for line in lines[body[0].lineno - 1:body[-1].end_lineno])
+    return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def retarget(cfg: CFG, lines: Optional[List[str]]) -> None:
+    # points a CFG and all of its nested function CFGs, built or not, at new source lines
+    pending = [cfg]
+    while pending:
+        curr = pending.pop()
+        curr.source_lines = lines
+        func_calls = curr.func_calls
+        for name, (tree, _, profiler) in func_calls.pending.items():
+            func_calls.pending[name] = (tree, lines, profiler)
+        pending.extend(func_calls.graphs[name] for name in func_calls.graphs if name not in func_calls.pending)
+
+
+def rebuild_from_source(old: CFG, source: str, name: Optional[str] = None, reformat: bool = False, strict: bool = False,
+                        profiler: Optional[Profiler] = None) -> Rebuild:
+    # Builds source like build_from_source, but takes over the function CFGs of old, the CFG of an earlier version
+    # of the same source, whose bodies are unchanged, only shifting the line numbers of their statements. The
+    # module-level graph is always rebuilt. Functions that are new or changed and whose enclosing graph was built
+    # in old are built right away and listed in rebuilt, qualified by their enclosing functions; functions whose
+    # CFG old never built stay lazy. old must not be used afterwards, its reused graphs belong to the new CFG.
+    cfg = build_from_source(source, name or old.name, reformat, strict, profiler)
+    rebuilt, reused = [], []
+    old_lines = old.source_lines
+    pending = [('', old.func_calls, cfg.func_calls)]
+    with stage(profiler, 'rebuild'):
+        while pending:
+            prefix, old_calls, new_calls = pending.pop()
+            for func in list(new_calls):
+                if func in old_calls and not old_calls.is_built(func):
+                    continue
+                old_tree, new_tree = old_calls.trees.get(func), new_calls.trees.get(func)
+                old_print = fingerprint(old_tree, old_lines) if old_tree is not None else None
+                if old_print is not None and new_tree is not None and old_print == fingerprint(new_tree, cfg.source_lines):
+                    graph = old_calls[func]
+                    ast.increment_lineno(old_tree, new_tree.body[0].lineno - old_tree.body[0].lineno)
+                    retarget(graph, cfg.source_lines)
+                    new_calls.adopt(func, graph, old_tree)
+                    reused.append(prefix + func)
+                    continue
+                new_calls[func]
+                rebuilt.append(prefix + func)
+                if func in old_calls:
+                    pending.append((prefix + func + '.', old_calls[func].func_calls, new_calls[func].func_calls))
+    return Rebuild(cfg, rebuilt, reused)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Generate control flow graphs for Python source files.')
+    arg_parser.add_argument('paths', nargs='+', help='source files, directories or glob patterns')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=None,
+                            help='number of worker processes in batch mode (default: cpu count); for a single file, '
+                                 'build its function CFGs on this many processes (default: 1)')
+    arg_parser.add_argument('-o', '--output-dir', default=None,
+                            help='write every output into this directory in batch mode; for a single file, the output path '
+                                 'without extension (default: ./output), or - to stream DOT to stdout')
+    arg_parser.add_argument('--format', default='pdf', help='graphviz output format')
+    arg_parser.add_argument('--emit', choices=['graph', 'shards', 'dot', 'dot.gz', 'json', 'binary'], default='graph',
+                            help='render with graphviz, render every function into its own file in parallel with an '
+                                 'index.html, write the DOT source (optionally gzip-compressed), '
+                                 'or write the graph structure as JSON or in the compact binary format')
+    arg_parser.add_argument('--reformat', action='store_true',
+                            help='strip comments and run autopep8 before building (line numbers then refer to the reformatted code)')
+    arg_parser.add_argument('--strict', action='store_true',
+                            help='also compile the parsed tree to report errors the parser accepts, e.g. return outside a function')
+    arg_parser.add_argument('--pattern', default='*.py', help='file name pattern used when walking directories')
+    arg_parser.add_argument('--cache-dir', default=None, help='reuse CFGs of unchanged sources stored in this directory')
+    arg_parser.add_argument('--cache-size', type=int, default=512, help='cache size limit in MiB (default: 512)')
+    arg_parser.add_argument('--profile', action='store_true',
+                            help='print wall time and allocated memory blocks per stage and graph counts to stderr')
+    arg_parser.add_argument('--trace', default=None, help='write the profiled stages to this file as a Chrome trace (JSON)')
+    arg_parser.add_argument('--metrics', default=None,
+                            help='write complexity metrics of every function to this CSV file (or .parquet, with pyarrow); '
+                                 'runs in batch mode, so CFGs are only rendered with --output-dir')
+    arg_parser.add_argument('--simplify', choices=['coalesce', 'compact'], default=None,
+                            help='merge straight-line chains of blocks after building; compact also drops unreachable blocks')
+    arg_parser.add_argument('--callgraph', default=None,
+                            help='resolve the calls between the functions of all given files and write the call graph to this JSON file')
+    arg_parser.add_argument('--reachable-from', action='append', default=None, metavar='FUNCTION',
+                            help='only build, write and render the functions reachable from this one (repeatable), '
+                                 'given as a qualified name such as pkg.mod.main or a module-level function name')
+    args = arg_parser.parse_args(argv)
+    profile = args.profile or args.trace is not None
+    cache_size = args.cache_size * 1024 * 1024
+    import batch
+
+    if args.callgraph or args.reachable_from:
+        # all files are built in this process, as calls are resolved across them; -o is always a directory
+        import callgraph
+        if args.callgraph is None and args.output_dir is None:
+            arg_parser.error('--reachable-from needs -o or --callgraph')
+        if args.emit != 'graph' and args.output_dir is None:
+            arg_parser.error('--emit {} requires --output-dir'.format(args.emit))
+        failed = callgraph.run(args.paths, args.pattern, args.reachable_from, args.callgraph, args.output_dir,
+                               args.emit, args.format, args.reformat, args.strict)
+        exit(1 if failed else 0)
+
+    filename = args.paths[0]
+    if len(args.paths) > 1 or not os.path.isfile(filename) or args.metrics:
+        if args.emit != 'graph' and args.output_dir is None:
+            arg_parser.error('--emit {} requires --output-dir in batch mode'.format(args.emit))
+        stats = batch.run_batch(args.paths, jobs=args.jobs, output_dir=args.output_dir, fmt=args.format, pattern=args.pattern,
+                                cache_dir=args.cache_dir, cache_size=cache_size, emit=args.emit,
+                                reformat=args.reformat, strict=args.strict, profile=profile, metrics_path=args.metrics,
+                                simplify=args.simplify)
+        print(stats.summary(cache=args.cache_dir is not None))
+        if profile:
+            report_profile(stats.profiler, args.profile, args.trace)
+        exit(1 if stats.failed else 0)
+
+    profiler = Profiler() if profile else None
     try:
-        source = open(filename, 'r').read()
-        compile(source, filename, 'exec')
-    except:
-        print('Error in source code')
+        with open(filename, 'r') as f:
+            source = f.read()
+        cache = None
+        if args.cache_dir:
+            from cache import CFGCache
+            cache = CFGCache(args.cache_dir, cache_size)
+        cfg, _ = batch.build_cached(source, filename, cache, args.reformat, args.strict, profiler, args.jobs or 1)
+    except (OSError, SyntaxError, ValueError, tokenize.TokenError) as e:
+        print('Error in source code: {}'.format(e))
         exit(1)
+    if args.simplify is not None:
+        with stage(profiler, 'simplify'):
+            cfg.coalesce(compact=args.simplify == 'compact')
+    if args.output_dir == '-' and args.emit == 'dot':
+        with stage(profiler, 'dot'):
+            cfg.write_dot(sys.stdout)
+    else:
+        cfg.save(args.output_dir or './output', args.emit, args.format, profiler=profiler)
+    if profiler is not None:
+        profiler.count(cfg)
+        report_profile(profiler, args.profile, args.trace)
+
+
+def report_profile(profiler: Profiler, show: bool, trace: Optional[str]) -> None:
+    if show:
+        print(profiler.report(), file=sys.stderr)
+    if trace is not None:
+        profiler.write_trace(trace)
 
-    parser = PyParser(source)
-    parser.removeCommentsAndDocstrings()
-    parser.formatCode()
-    cfg = CFGVisitor().build(filename, ast.parse(parser.script))
-    cfg.show()
\ No newline at end of file
+
+if __name__ == '__main__':
+    main()
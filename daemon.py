@@ -0,0 +1,270 @@
+from __future__ import annotations
+import hashlib, json, os, socket, socketserver, sys, tempfile, threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from batch import iter_sources
+from callgraph import CallGraph, module_name
+from cfg import CFG, __version__, build_from_source, rebuild_from_source
+
+DEFAULT_MAX_BYTES: int = 32 * 1024 * 1024
+
+
+class Project:
+    # In-memory CFGs of the Python files below a root directory. Modules are built on first use and kept in an
+    # LRU whose size is measured in bytes of source, a proxy for the memory of the trees and CFGs built from it;
+    # function CFGs are only built when a query needs them (CFG.func_calls is lazy). scan() polls the files and
+    # rebuilds the cached modules whose files changed, reusing the CFGs of unchanged functions; the others are
+    # only rebuilt when they are queried again.
+    # All methods are meant to be called with lock held.
+
+    def __init__(self, root: str, pattern: str = '*.py', max_bytes: int = DEFAULT_MAX_BYTES, reformat: bool = False):
+        self.root: str = os.path.abspath(root)
+        self.pattern: str = pattern
+        self.max_bytes: int = max_bytes
+        self.reformat: bool = reformat
+        self.lock: threading.RLock = threading.RLock()
+        self.files: Dict[str, Tuple[int, int]] = {}
+        self.paths: Dict[str, str] = {}
+        self.packages: Dict[str, str] = {}
+        self.cached: OrderedDict[str, Tuple[CFG, int]] = OrderedDict()
+        self.bytes: int = 0
+        self.builds: int = 0
+        self.rebuilds: int = 0
+        self.hits: int = 0
+        self.evictions: int = 0
+
+    def scan(self) -> List[str]:
+        # paths of the files that were added, changed or removed since the last scan
+        changed = []
+        seen = set()
+        for path in iter_sources([self.root], self.pattern):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            seen.add(path)
+            state = (st.st_mtime_ns, st.st_size)
+            if self.files.get(path) == state:
+                continue
+            changed.append(path)
+            self.files[path] = state
+            module, package = module_name(path)
+            self.paths[module] = path
+            self.packages[module] = module if package else module.rpartition('.')[0]
+            if path in self.cached:
+                self.rebuilds += 1
+                try:
+                    self.reload(path)
+                except Exception:
+                    # reported again when the file is queried
+                    self.discard(path)
+        for path in [path for path in self.files if path not in seen]:
+            changed.append(path)
+            del self.files[path]
+            self.discard(path)
+            module = module_name(path)[0]
+            if self.paths.get(module) == path:
+                del self.paths[module]
+                del self.packages[module]
+        return changed
+
+    def discard(self, path: str) -> None:
+        if path in self.cached:
+            self.bytes -= self.cached.pop(path)[1]
+
+    def load(self, path: str) -> CFG:
+        if path in self.cached:
+            self.cached.move_to_end(path)
+            self.hits += 1
+            return self.cached[path][0]
+        with open(path, 'r') as f:
+            source = f.read()
+        cfg = build_from_source(source, module_name(path)[0], self.reformat)
+        self.builds += 1
+        self.cached[path] = (cfg, len(source))
+        self.bytes += len(source)
+        while self.bytes > self.max_bytes and len(self.cached) > 1:
+            self.bytes -= self.cached.popitem(last=False)[1][1]
+            self.evictions += 1
+        return cfg
+
+    def reload(self, path: str) -> CFG:
+        # rebuilds a cached module, reusing the CFGs of its functions that did not change
+        old = self.cached[path][0]
+        with open(path, 'r') as f:
+            source = f.read()
+        cfg = rebuild_from_source(old, source, old.name, self.reformat).cfg
+        self.discard(path)
+        self.cached[path] = (cfg, len(source))
+        self.bytes += len(source)
+        return cfg
+
+    def path(self, request: Dict[str, Any]) -> str:
+        # a request names its file by path (relative to the root or absolute) or by module
+        if 'module' in request:
+            if request['module'] not in self.paths:
+                raise LookupError('no module {}'.format(request['module']))
+            return self.paths[request['module']]
+        path = os.path.abspath(os.path.join(self.root, request['file']))
+        if path not in self.files:
+            raise LookupError('no file {}'.format(request['file']))
+        return path
+
+    def graph(self, request: Dict[str, Any]) -> Tuple[str, CFG]:
+        # (qualified name, CFG) of the module or of its function named by the dotted path in request['function']
+        cfg = self.load(self.path(request))
+        name = cfg.name
+        for part in request['function'].split('.') if request.get('function') else []:
+            if part not in cfg.func_calls:
+                raise LookupError('no function {} in {}'.format(part, name))
+            cfg = cfg.func_calls[part]
+            name += '.' + part
+        return name, cfg
+
+    def handle(self, request: Dict[str, Any]) -> Any:
+        op = request.get('op')
+        if op == 'ping':
+            return {'version': __version__, 'root': self.root}
+        if op == 'functions':
+            return list(self.graph(request)[1].func_calls)
+        if op == 'cfg':
+            return self.graph(request)[1].to_dict()
+        if op == 'metrics':
+            name, cfg = self.graph(request)
+            return [[function, values] for function, values in cfg.function_metrics(name[:len(name) - len(cfg.name)])]
+        if op == 'calls':
+            name, cfg = self.graph(request)
+            callgraph = CallGraph(ProjectModules(self), self.packages)
+            return [site._asdict() for site in callgraph.call_sites(name)]
+        if op == 'rescan':
+            return self.scan()
+        if op == 'stats':
+            return {'files': len(self.files), 'cached': len(self.cached), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'builds': self.builds, 'rebuilds': self.rebuilds, 'hits': self.hits, 'evictions': self.evictions}
+        raise ValueError('unknown op {!r}'.format(op))
+
+
+class ProjectModules(Mapping):
+    # the modules of a project by name, loaded through its LRU, for resolving calls across files
+
+    def __init__(self, project: Project):
+        self.project: Project = project
+
+    def __getitem__(self, module: str) -> CFG:
+        return self.project.load(self.project.paths[module])
+
+    def __contains__(self, module: object) -> bool:
+        return module in self.project.paths
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.project.paths)
+
+    def __len__(self) -> int:
+        return len(self.project.paths)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    # one JSON request per line, answered by one line of JSON: {"ok": true, "result": ...} or {"ok": false, "error": ...}
+
+    def handle(self) -> None:
+        project = self.server.project
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            request = None
+            try:
+                request = json.loads(line)
+                if request.get('op') == 'shutdown':
+                    response = {'ok': True, 'result': None}
+                else:
+                    with project.lock:
+                        response = {'ok': True, 'result': project.handle(request)}
+            except Exception as e:
+                response = {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+            if isinstance(request, dict) and request.get('op') == 'shutdown':
+                # from another thread, as shutdown() waits for serve_forever() to return
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, project: Project):
+        self.project: Project = project
+        super().__init__(socket_path, RequestHandler)
+
+
+def default_socket(root: str) -> str:
+    digest = hashlib.sha256(os.path.abspath(root).encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), 'cfg-daemon-{}.sock'.format(digest))
+
+
+def serve(root: str, socket_path: Optional[str] = None, interval: float = 1.0, pattern: str = '*.py',
+          max_bytes: int = DEFAULT_MAX_BYTES, reformat: bool = False) -> None:
+    # Blocks until a shutdown request. The files are polled every interval seconds, as the standard library has
+    # no portable file change notification.
+    socket_path = socket_path or default_socket(root)
+    project = Project(root, pattern, max_bytes, reformat)
+    with project.lock:
+        project.scan()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    stop = threading.Event()
+
+    def watch() -> None:
+        while not stop.wait(interval):
+            with project.lock:
+                project.scan()
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+    try:
+        with Server(socket_path, project) as server:
+            print('serving {} on {}'.format(project.root, socket_path), file=sys.stderr)
+            server.serve_forever()
+    finally:
+        stop.set()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def query(socket_path: str, request: Dict[str, Any], timeout: Optional[float] = 30.0) -> Any:
+    # sends one request to a running daemon and returns its result; errors of the daemon raise RuntimeError
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as f:
+            f.write(json.dumps(request).encode() + b'\n')
+            f.flush()
+            response = json.loads(f.readline())
+    if not response['ok']:
+        raise RuntimeError(response['error'])
+    return response['result']
+
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Keep the CFGs of a project in memory and answer queries over a Unix socket.')
+    arg_parser.add_argument('root', nargs='?', default='.', help='project root directory (default: .)')
+    arg_parser.add_argument('--socket', default=None, help='socket path (default: derived from the root, in the temp directory)')
+    arg_parser.add_argument('--interval', type=float, default=1.0, help='seconds between polls for changed files')
+    arg_parser.add_argument('--pattern', default='*.py', help='file name pattern of the sources')
+    arg_parser.add_argument('--max-mib', type=int, default=DEFAULT_MAX_BYTES // 2 ** 20,
+                            help='MiB of source whose CFGs are kept in memory (default: 32)')
+    arg_parser.add_argument('--reformat', action='store_true', help='build as cfg.py --reformat does')
+    arg_parser.add_argument('--query', default=None, metavar='JSON',
+                            help='send this request to a running daemon and print the result, e.g. {"op": "stats"}')
+    args = arg_parser.parse_args()
+    if args.query is not None:
+        try:
+            print(json.dumps(query(args.socket or default_socket(args.root), json.loads(args.query)), indent=1))
+        except (OSError, RuntimeError) as e:
+            print('error: {}'.format(e), file=sys.stderr)
+            sys.exit(1)
+    else:
+        serve(args.root, args.socket, args.interval, args.pattern, args.max_mib * 1024 * 1024, args.reformat)
@@ -0,0 +1,89 @@
+from __future__ import annotations
+import contextlib, json, os, sys, threading, time
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+
+class Profiler:
+    # Records wall time and the change in live allocated memory blocks (sys.getallocatedblocks) of named stages.
+    # Stages nest: each one reports its inclusive time and its self time, i.e. without the stages inside it, and
+    # a stage nested in one of the same name (the build of a nested function) is not counted twice.
+    # Every stage is also kept as a complete event in the Chrome trace event format (chrome://tracing, Perfetto).
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, int] = {}
+        self.graphs: Dict[str, Dict[str, int]] = {}
+        self.events: List[Dict[str, Any]] = []
+        self._stack: List[List] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str, /, **args: Any) -> Iterator[None]:
+        frame = [name, 0.0]
+        outermost = all(parent[0] != name for parent in self._stack)
+        self._stack.append(frame)
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            allocated = sys.getallocatedblocks() - blocks
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][1] += elapsed
+            stats = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'self_seconds': 0.0, 'allocated_blocks_delta': 0})
+            stats['calls'] += 1
+            stats['self_seconds'] += elapsed - frame[1]
+            if outermost:
+                stats['seconds'] += elapsed
+                stats['allocated_blocks_delta'] += allocated
+            event = {'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': elapsed * 1e6, 'pid': os.getpid(),
+                     'tid': threading.get_ident(), 'args': dict(args, **{'Δ allocated blocks': allocated})}
+            self.events.append(event)
+
+    def count(self, cfg, prefix: str = '') -> Dict[str, int]:
+        # per-graph and total counts of a CFG and all of its nested function CFGs
+        pending = [(prefix + cfg.name, cfg)]
+        while pending:
+            name, curr = pending.pop()
+            counts = curr.stats()
+            self.graphs[name] = counts
+            for key, value in counts.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            pending.extend((name + '.' + k, v) for k, v in curr.func_calls.items())
+        return self.counters
+
+    def merge(self, data: Dict[str, Any]) -> None:
+        # adds the to_dict() of another profiler, e.g. one that ran in a worker process
+        for name, stats in data['stages'].items():
+            total = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'self_seconds': 0.0, 'allocated_blocks_delta': 0})
+            for key, value in stats.items():
+                total[key] += value
+        for key, value in data['counters'].items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.graphs.update(data['graphs'])
+        self.events.extend(data['events'])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'stages': self.stages, 'counters': self.counters, 'graphs': self.graphs, 'events': self.events}
+
+    def report(self) -> str:
+        lines = ['{:<22} {:>7} {:>11} {:>11} {:>18}'.format('stage', 'calls', 'total ms', 'self ms', 'Δ allocated blocks')]
+        for name, stats in sorted(self.stages.items(), key=lambda item: -item[1]['seconds']):
+            lines.append('{:<22} {:>7} {:>11.2f} {:>11.2f} {:>+18}'.format(
+                name, stats['calls'], 1000 * stats['seconds'], 1000 * stats['self_seconds'], stats['allocated_blocks_delta']))
+        if self.counters:
+            lines.append(', '.join('{} {}'.format(value, key) for key, value in self.counters.items()))
+        return '\n'.join(lines)
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        return {'traceEvents': self.events, 'displayTimeUnit': 'ms', 'otherData': {'counters': self.counters, 'graphs': self.graphs}}
+
+    def write_trace(self, filepath: str) -> None:
+        with open(filepath, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+
+def stage(profiler: Optional[Profiler], name: str, /, **args: Any) -> ContextManager[None]:
+    # the call sites stay the same whether or not a profiler was passed
+    return profiler.stage(name, **args) if profiler is not None else contextlib.nullcontext()
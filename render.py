@@ -0,0 +1,241 @@
+from __future__ import annotations
+import asyncio, html, io, os, re, signal, subprocess, time
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+
+from cfg import CFG
+
+# a CFG, or DOT source that was already generated
+Graph = Union[CFG, str, bytes]
+
+
+class RenderResult(NamedTuple):
+    filepath: str
+    output: Optional[str]
+    seconds: float
+    error: Optional[str] = None
+
+
+class RenderError(Exception):
+
+    def __init__(self, filepath: str, message: str):
+        super().__init__('{}: {}'.format(filepath, message))
+        self.filepath: str = filepath
+
+
+def describe(error: Exception) -> str:
+    # message of a failed render; anything but graphviz failing, e.g. an error building a function CFG that was
+    # not built yet for its DOT source, is named by its type
+    return str(error) if isinstance(error, (RenderError, OSError)) else '{}: {}'.format(type(error).__name__, error)
+
+
+def dot_source(graph: Graph, calls: bool = True, nested: bool = True) -> bytes:
+    if isinstance(graph, CFG):
+        out = io.StringIO()
+        graph.write_dot(out, calls, nested=nested)
+        graph = out.getvalue()
+    return graph.encode() if isinstance(graph, str) else graph
+
+
+def command(output: str, fmt: str, engine: str) -> List[str]:
+    return [engine, '-T' + fmt, '-o', output]
+
+
+class Renderer:
+    # Renders graphs by piping their DOT source into graphviz subprocesses, at most jobs of them at a time, each
+    # killed after timeout seconds (None: no limit). Nothing is ever opened in a viewer. Outputs are written to
+    # filepath + '.' + fmt, as CFG.show does. The coroutines must run on one event loop, which the semaphore is
+    # bound to; cancelling one kills its subprocess. With nested=False, the functions nested in a CFG are left out
+    # of its drawing.
+
+    def __init__(self, jobs: Optional[int] = None, timeout: Optional[float] = None, fmt: str = 'pdf', engine: str = 'dot',
+                 nested: bool = True):
+        self.jobs: int = jobs or os.cpu_count() or 1
+        self.timeout: Optional[float] = timeout
+        self.fmt: str = fmt
+        self.engine: str = engine
+        self.nested: bool = nested
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.jobs)
+        return self._semaphore
+
+    async def render(self, graph: Graph, filepath: str, fmt: Optional[str] = None) -> str:
+        # returns the path of the output; raises RenderError if graphviz fails or times out
+        output = filepath + '.' + (fmt or self.fmt)
+        async with self.semaphore:
+            # generated once a slot is free, so at most jobs DOT sources are held at a time
+            source = dot_source(graph, nested=self.nested)
+            process = await asyncio.create_subprocess_exec(*command(output, fmt or self.fmt, self.engine), stdin=asyncio.subprocess.PIPE,
+                                                           stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+                                                           start_new_session=hasattr(os, 'killpg'))
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(source), self.timeout)
+            except asyncio.TimeoutError:
+                await self._kill(process)
+                raise RenderError(filepath, 'timed out after {}s'.format(self.timeout)) from None
+            except BaseException:
+                # cancelled
+                await self._kill(process)
+                raise
+        if process.returncode:
+            raise RenderError(filepath, stderr.decode(errors='replace').strip() or 'exit status {}'.format(process.returncode))
+        return output
+
+    @staticmethod
+    async def _kill(process: asyncio.subprocess.Process) -> None:
+        # the whole process group, so a wrapper script cannot leave the pipes open
+        if process.returncode is None:
+            if hasattr(os, 'killpg'):
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            else:
+                process.kill()
+            await process.wait()
+
+    async def _result(self, graph: Graph, filepath: str) -> RenderResult:
+        start = time.perf_counter()
+        try:
+            return RenderResult(filepath, await self.render(graph, filepath), time.perf_counter() - start)
+        except Exception as e:
+            return RenderResult(filepath, None, time.perf_counter() - start, describe(e))
+
+    async def render_many(self, graphs: Iterable[Tuple[Graph, str]]) -> List[RenderResult]:
+        # renders (graph, filepath) pairs concurrently; failures are reported in the results instead of raised
+        return await asyncio.gather(*(self._result(graph, filepath) for graph, filepath in graphs))
+
+    def render_sync(self, graph: Graph, filepath: str, fmt: Optional[str] = None) -> str:
+        # blocking render for threads, killing the process group on timeout like render
+        output = filepath + '.' + (fmt or self.fmt)
+        source = dot_source(graph, nested=self.nested)
+        process = subprocess.Popen(command(output, fmt or self.fmt, self.engine), stdin=subprocess.PIPE,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=hasattr(os, 'killpg'))
+        try:
+            _, stderr = process.communicate(source, self.timeout)
+        except subprocess.TimeoutExpired:
+            self._kill_sync(process)
+            raise RenderError(filepath, 'timed out after {}s'.format(self.timeout)) from None
+        except BaseException:
+            self._kill_sync(process)
+            raise
+        if process.returncode:
+            raise RenderError(filepath, stderr.decode(errors='replace').strip() or 'exit status {}'.format(process.returncode))
+        return output
+
+    @staticmethod
+    def _kill_sync(process: subprocess.Popen) -> None:
+        if process.poll() is None:
+            if hasattr(os, 'killpg'):
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            else:
+                process.kill()
+        # closes the pipes
+        process.communicate()
+
+    def _result_sync(self, item: Tuple[Graph, str]) -> RenderResult:
+        start = time.perf_counter()
+        try:
+            return RenderResult(item[1], self.render_sync(*item), time.perf_counter() - start)
+        except Exception as e:
+            return RenderResult(item[1], None, time.perf_counter() - start, describe(e))
+
+    def render_threaded(self, graphs: Iterable[Tuple[Graph, str]]) -> List[RenderResult]:
+        # render_many for synchronous callers, on a pool of jobs threads; the subprocesses run in parallel while
+        # the threads wait for them, only DOT generation holds the GIL
+        with ThreadPoolExecutor(self.jobs) as pool:
+            return list(pool.map(self._result_sync, graphs))
+
+
+def render_all(graphs: Iterable[Tuple[Graph, str]], jobs: Optional[int] = None, timeout: Optional[float] = None,
+               fmt: str = 'pdf', engine: str = 'dot') -> List[RenderResult]:
+    # convenience entry point for code without an event loop
+    return asyncio.run(Renderer(jobs, timeout, fmt, engine).render_many(graphs))
+
+
+def shards(cfg: CFG) -> List[Tuple[str, int, Optional[CFG], Optional[str]]]:
+    # (qualified name, nesting depth, CFG, error) of the graph and every nested function CFG, in the order of
+    # write_dot. Function CFGs are built here, one at a time: one that fails to build has no CFG but the error,
+    # and the functions nested in it are left out.
+    result: List[Tuple[str, int, Optional[CFG], Optional[str]]] = [(cfg.name, 0, cfg, None)]
+    pending = [(cfg.name + '.' + k, 1, cfg, k) for k in reversed(list(cfg.func_calls))]
+    while pending:
+        name, depth, parent, function = pending.pop()
+        try:
+            curr = parent.func_calls[function]
+        except Exception as e:
+            result.append((name, depth, None, describe(e)))
+            continue
+        result.append((name, depth, curr, None))
+        pending.extend((name + '.' + k, depth + 1, curr, k) for k in reversed(list(curr.func_calls)))
+    return result
+
+
+def shard_filename(name: str, taken: Set[str]) -> str:
+    # file name of a qualified name; the names of lambdas and comprehensions contain spaces and angle brackets
+    base = re.sub(r'[^A-Za-z0-9_.-]', '_', name.replace(os.sep, '_')).strip('.') or 'graph'
+    filename, i = base, 1
+    while filename.lower() in taken:
+        i += 1
+        filename = '{}-{}'.format(base, i)
+    taken.add(filename.lower())
+    return filename
+
+
+def render_sharded(cfg: CFG, directory: str, fmt: str = 'pdf', jobs: Optional[int] = None,
+                   timeout: Optional[float] = None, engine: str = 'dot') -> List[RenderResult]:
+    # Renders every function CFG on its own, without the functions nested in it, into directory on jobs threads,
+    # and writes directory/index.html linking them. Graphviz layout is superlinear in the size of a graph, so this
+    # takes about as long as the largest function instead of the whole module in one clustered graph.
+    os.makedirs(directory, exist_ok=True)
+    graphs = shards(cfg)
+    # named relative to the module, whose own graph is <module>
+    taken: Set[str] = {'index'}
+    paths = [os.path.join(directory, shard_filename(name[len(cfg.name) + 1:] or '<module>', taken)) for name, _, _, _ in graphs]
+    rendered = iter(Renderer(jobs, timeout, fmt, engine, nested=False).render_threaded(
+        [(graph, path) for (_, _, graph, _), path in zip(graphs, paths) if graph is not None]))
+    results = [next(rendered) if graph is not None else RenderResult(path, None, 0.0, error)
+               for (_, _, graph, error), path in zip(graphs, paths)]
+    write_index(os.path.join(directory, 'index.html'), cfg.name,
+                [(name, depth, graph.stats()['blocks'] if graph is not None else None, result)
+                 for (name, depth, graph, _), result in zip(graphs, results)])
+    return results
+
+
+def write_index(filepath: str, title: str, entries: List[Tuple[str, int, Optional[int], RenderResult]]) -> None:
+    # one nested list item per (qualified name, depth, blocks, result), linking to the rendered file; blocks is
+    # None for a function whose CFG could not be built
+    directory = os.path.dirname(filepath)
+    lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8"><title>{}</title></head><body>'.format(html.escape(title)),
+             '<h1>{}</h1>'.format(html.escape(title))]
+    # pre-order, so the depth grows by at most one from one entry to the next
+    current = -1
+    for name, depth, blocks, result in entries:
+        if depth > current:
+            lines.append('<ul>')
+        else:
+            lines.append('</li>')
+            lines.extend(['</ul></li>'] * (current - depth))
+        current = depth
+        label = html.escape(name.rpartition('.')[2] if depth else name)
+        if result.output is not None:
+            link = quote(os.path.relpath(result.output, directory).replace(os.sep, '/'))
+            lines.append('<li><a href="{}">{}</a> ({} blocks)'.format(link, label, blocks))
+        else:
+            size = ' ({} blocks)'.format(blocks) if blocks is not None else ''
+            lines.append('<li>{}{}: {}'.format(label, size, html.escape(result.error or '')))
+    if current >= 0:
+        lines.append('</li>')
+        lines.extend(['</ul></li>'] * current)
+        lines.append('</ul>')
+    lines.append('</body></html>')
+    with open(filepath, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
@@ -0,0 +1,24 @@
+import pytest
+
+from batch import build_cached, run_batch
+from cache import CFGCache
+
+
+def test_build_errors_are_reported_per_file(tmp_path, capsys):
+    # function CFGs are built lazily, after the module; an error there must fail only its own file
+    (tmp_path / 'ok.py').write_text('x = 1\n')
+    (tmp_path / 'bad.py').write_text('def f():\n    break\n')
+    for profile, metrics in [(True, None), (False, str(tmp_path / 'metrics.csv'))]:
+        stats = run_batch([str(tmp_path)], jobs=1, pattern='*.py', profile=profile, metrics_path=metrics)
+        assert (stats.files, stats.failed) == (2, 1)
+    assert 'bad.py' in capsys.readouterr().err
+
+
+def test_strict_builds_are_cached_apart(tmp_path):
+    # 'return' outside a function parses, only strict compiling rejects it
+    cache = CFGCache(str(tmp_path / 'cache'))
+    source = 'return 1\n'
+    assert build_cached(source, 'top.py', cache)[1] is False
+    assert build_cached(source, 'top.py', cache)[1] is True
+    with pytest.raises(SyntaxError):
+        build_cached(source, 'top.py', cache, strict=True)
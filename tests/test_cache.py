@@ -0,0 +1,76 @@
+import os
+
+from cache import CFGCache
+from cfg import build_from_source
+
+SOURCE = 'def f(x):\n    if x:\n        return g(x)\n    return 0\n'
+
+
+def test_get_put(tmp_path):
+    cache = CFGCache(str(tmp_path))
+    key = cache.key(SOURCE, 'original')
+    assert cache.get(key) is None
+    cfg = build_from_source(SOURCE, 'mod')
+    cache.put(key, cfg)
+    loaded = cache.get(key)
+    assert loaded.to_dict() == cfg.to_dict()
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'stores': 1, 'evictions': 0}
+
+
+def test_keys_depend_on_source_and_options(tmp_path):
+    cache = CFGCache(str(tmp_path))
+    assert cache.key(SOURCE, 'original') != cache.key(SOURCE, 'reformat')
+    assert cache.key(SOURCE, 'original') != cache.key(SOURCE + '\n', 'original')
+
+
+def test_get_or_build_renames_shared_entries(tmp_path):
+    cache = CFGCache(str(tmp_path))
+    built = []
+    build = lambda: built.append(1) or build_from_source(SOURCE, 'a.py')
+    cfg, cached = cache.get_or_build(SOURCE, 'a.py', build)
+    assert not cached and cfg.name == 'a.py'
+    cfg, cached = cache.get_or_build(SOURCE, 'b.py', build)
+    assert cached and cfg.name == 'b.py'
+    assert len(built) == 1
+
+
+def test_corrupt_entries_are_misses(tmp_path):
+    cache = CFGCache(str(tmp_path))
+    key = cache.key(SOURCE)
+    with open(cache.path(key), 'wb') as f:
+        f.write(b'garbage')
+    assert cache.get(key) is None
+    assert not os.path.exists(cache.path(key))
+
+
+def test_trim_evicts_least_recently_used(tmp_path):
+    cache = CFGCache(str(tmp_path))
+    keys = []
+    for i in range(4):
+        source = SOURCE + 'y = {}\n'.format(i)
+        keys.append(cache.key(source))
+        cache.put(keys[-1], build_from_source(source, 'mod'))
+        os.utime(cache.path(keys[-1]), (1000 + i, 1000 + i))
+    size = os.path.getsize(cache.path(keys[0]))
+    cache.max_bytes = 2 * size + size // 2
+    assert cache.trim() == 2
+    assert [os.path.exists(cache.path(key)) for key in keys] == [False, False, True, True]
+
+
+def test_trim_threshold_is_shared_between_instances(tmp_path):
+    # batch mode creates one cache per file, the bytes written by all of them count towards the next trim
+    size = None
+    for i in range(20):
+        source = SOURCE + 'y = {}\n'.format(i)
+        cache = CFGCache(str(tmp_path), 8 * 3000)
+        cache.put(cache.key(source), build_from_source(source, 'mod'))
+        size = size or os.path.getsize(cache.path(cache.key(source)))
+    assert CFGCache(str(tmp_path)).info()['bytes'] <= max(8 * 3000, size)
+
+
+def test_clear(tmp_path):
+    cache = CFGCache(str(tmp_path))
+    cache.put(cache.key(SOURCE), build_from_source(SOURCE, 'mod'))
+    cache.clear()
+    assert cache.info()['entries'] == 0
+    assert os.listdir(str(tmp_path)) == []
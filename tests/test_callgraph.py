@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+import callgraph
+from cfg import main
+
+INIT = '''\
+from .mod import main
+
+def setup():
+    pass
+'''
+
+MOD = '''\
+from .util import helper
+
+def main():
+    helper()
+    broken()
+
+def broken():
+    break
+
+def unused():
+    pass
+'''
+
+UTIL = '''\
+def helper():
+    pass
+
+def other():
+    pass
+'''
+
+
+@pytest.fixture
+def package(tmp_path, monkeypatch):
+    (tmp_path / 'pkg').mkdir()
+    for name, source in [('__init__', INIT), ('mod', MOD), ('util', UTIL)]:
+        (tmp_path / 'pkg' / (name + '.py')).write_text(source)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def functions(path):
+    with open(path) as f:
+        return sorted(json.load(f)['func_calls'])
+
+
+def test_reachable_from(package):
+    graph = callgraph.CallGraph()
+    for name in ['__init__', 'mod', 'util']:
+        path = str(package / 'pkg' / (name + '.py'))
+        module, is_package = callgraph.module_name(path)
+        with open(path) as f:
+            graph.add(callgraph.build_from_source(f.read(), module), module, is_package)
+    assert graph.find('main') == ['pkg.mod.main']
+    assert graph.reachable(['pkg.mod.main']) == ['pkg.mod.main', 'pkg.util.helper', 'pkg.mod.broken']
+    assert graph.resolve('pkg', 'main') == 'pkg.mod.main'
+
+
+def test_restricted_output_skips_broken_functions_and_unreached_modules(package, capsys):
+    failed = callgraph.run(['pkg'], roots=['pkg.mod.main'], output_dir='out', emit='json')
+    assert failed == 1
+    assert 'pkg.mod.broken' in capsys.readouterr().err
+    assert functions(package / 'out' / 'pkg' / 'mod.json') == ['main']
+    assert functions(package / 'out' / 'pkg' / 'util.json') == ['helper']
+    # a package __init__ is not written for the functions of its submodules
+    assert not (package / 'out' / 'pkg' / '__init__.json').exists()
+
+
+def test_reachable_from_needs_an_output(package):
+    with pytest.raises(SystemExit) as exc:
+        main(['pkg', '--reachable-from', 'main'])
+    assert exc.value.code == 2
@@ -0,0 +1,27 @@
+import io
+
+from cfg import build_from_source
+
+SOURCE = '''\
+def f(a, xs):
+    g(a)
+    a.b.c()
+    a[0]()
+    h()()
+    ''.join(xs)
+    a[0][1]()
+    a.b[0]()
+    (a or g)()
+'''
+
+
+def test_unresolved_calls_are_none():
+    cfg = build_from_source(SOURCE, 'calls')
+    calls = [call for block in cfg.func_calls['f'].blocks.values() for call in block.calls]
+    assert calls == ['g', 'a.b.c', 'a', 'h()', None, None, None, None]
+
+
+def test_unresolved_calls_are_left_out_of_dot():
+    out = io.StringIO()
+    build_from_source(SOURCE, 'calls').func_calls['f'].write_dot(out)
+    assert 'None' not in out.getvalue()
@@ -0,0 +1,80 @@
+import glob, os
+
+import pytest
+
+from cfg import build_from_source
+
+EXAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples', '*.py')))
+
+SOURCE = '''\
+def f(x):
+    a = g(x)
+    b = h(a)
+    assert b, 'no b'
+    c = k(b)
+    if c:
+        return 1
+        dead()
+    while x:
+        x -= 1
+        m(x)
+    return 0
+'''
+
+# the success edge of an assert is conditional, merging it away drops one conditional edge
+KEPT = ('cyclomatic', 'stmts', 'calls', 'branches', 'loops', 'max_loop_depth', 'else_edges',
+        'break_edges', 'exception_edges', 'finally_edges')
+
+
+def graphs(cfg):
+    pending = [cfg]
+    while pending:
+        curr = pending.pop()
+        yield curr
+        pending.extend(curr.func_calls.values())
+
+
+def check_links(cfg):
+    for graph in graphs(cfg):
+        edges = set()
+        for block in graph.blocks.values():
+            for next_bid in block.next:
+                assert block.bid in graph.blocks[next_bid].prev
+                edges.add((block.bid, next_bid))
+            for prev_bid in block.prev:
+                assert block.bid in graph.blocks[prev_bid].next
+        assert set(graph.edges) == edges
+
+
+def sources():
+    yield 'source', SOURCE
+    for path in EXAMPLES:
+        with open(path) as f:
+            yield path, f.read()
+
+
+@pytest.mark.parametrize('name,source', list(sources()), ids=lambda value: os.path.basename(value)[:20])
+def test_coalesce_keeps_metrics_and_links(name, source):
+    cfg = build_from_source(source, name)
+    before = {name: {key: values[key] for key in KEPT} for name, values in cfg.function_metrics()}
+    blocks = sum(len(graph.blocks) for graph in graphs(cfg))
+    removed = cfg.coalesce()
+    assert sum(len(graph.blocks) for graph in graphs(cfg)) == blocks - removed
+    assert {name: {key: values[key] for key in KEPT} for name, values in cfg.function_metrics()} == before
+    check_links(cfg)
+    assert cfg.coalesce() == 0
+
+
+def test_coalesce_merges_chains():
+    f = build_from_source(SOURCE, 'mod').func_calls['f']
+    f.coalesce()
+    # the calls before the if, the assert included, end up in the start block, in order
+    assert f.start.calls == ['g', 'h', 'k']
+    assert len(f.start.next) == 2
+
+
+def test_compact_drops_unreachable_blocks():
+    f = build_from_source(SOURCE, 'mod').func_calls['f']
+    f.coalesce(compact=True)
+    assert 'dead' not in [call for block in f.blocks.values() for call in block.calls]
+    check_links(f)
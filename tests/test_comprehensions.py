@@ -0,0 +1,44 @@
+from cfg import build_from_source
+
+SOURCE = '''\
+def f(y, z):
+    a = [g(x) for x in y if x]
+    d = {k: [h(v) for v in k] for k in z}
+    s = (m(x) for x in y if x)
+    return a, d, s
+'''
+
+
+def blocks(graph):
+    # (label, calls, successors) of the live blocks
+    return [(block.stmts_to_code(graph.source_lines), block.calls, list(block.next)) for block in graph.live_blocks()]
+
+
+def test_list_comprehension_blocks():
+    f = build_from_source(SOURCE, 'comps').func_calls['f']
+    assert blocks(f)[:4] == [
+        ('a = []\n', [], [2]),
+        ('for x in y:\n', [], [3, 4]),
+        ('if x:\n', [], [6, 2]),
+        ('d = {}\n', [], [7]),
+    ]
+    # the element is appended in the body of the loop, which jumps back to its guard
+    assert ('a.append(g(x))\n', ['g', 'a.append'], [2]) in blocks(f)
+
+
+def test_nested_comprehensions_are_expanded():
+    f = build_from_source(SOURCE, 'comps').func_calls['f']
+    assert ('for v in k:\n', [], [10, 11]) in blocks(f)
+    assert ('h(v)\n', ['h'], [8]) in blocks(f)
+    metrics = f.metrics()
+    assert (metrics['loops'], metrics['max_loop_depth']) == (3, 2)
+
+
+def test_generator_expressions_become_functions():
+    f = build_from_source(SOURCE, 'comps').func_calls['f']
+    assert list(f.func_calls) == ['__sGenerator__']
+    assert blocks(f.func_calls['__sGenerator__']) == [
+        ('for x in y:\n', [], [2]),
+        ('if x:\n', [], [5, 1]),
+        ('yield m(x)\n', ['m'], [1]),
+    ]
@@ -0,0 +1,40 @@
+import pytest
+
+from cfg import build_from_source
+
+np = pytest.importorskip('numpy')
+
+SOURCE = '''\
+def f(x):
+    if x:
+        return g(x)
+    return 0
+
+def h(xs):
+    for x in xs:
+        f(x)
+'''
+
+
+def test_csr_matches_blocks():
+    cfg = build_from_source(SOURCE, 'mod')
+    csr = cfg.to_csr()
+    assert csr.graphs == ['mod', 'mod.f', 'mod.h']
+    assert csr.indptr[-1] == len(csr.indices) == len(csr.kinds)
+    for g, name in enumerate(csr.graphs):
+        graph = cfg if g == 0 else cfg.func_calls[name.rpartition('.')[2]]
+        nodes = range(csr.graph_ptr[g], csr.graph_ptr[g + 1])
+        assert [csr.block_ids[i] for i in nodes] == [block.bid for block in graph.live_blocks()]
+        assert csr.block_ids[csr.starts[g]] == graph.start.bid
+        for i in nodes:
+            block = graph.blocks[csr.block_ids[i]]
+            successors = csr.indices[csr.indptr[i]:csr.indptr[i + 1]]
+            assert [csr.block_ids[j] for j in successors] == list(block.next)
+            assert list(csr.kinds[csr.indptr[i]:csr.indptr[i + 1]]) == [graph.edge_kind(block.bid, bid) for bid in block.next]
+
+
+def test_reachable_stays_in_its_graph():
+    pytest.importorskip('scipy')
+    csr = build_from_source(SOURCE, 'mod').to_csr()
+    reached = csr.reachable(int(csr.starts[1]))
+    assert all(csr.graph_ptr[1] <= node < csr.graph_ptr[2] for node in reached)
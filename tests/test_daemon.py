@@ -0,0 +1,59 @@
+import socket, threading
+
+import pytest
+
+import daemon
+
+
+@pytest.fixture
+def project(tmp_path):
+    (tmp_path / 'pkg').mkdir()
+    (tmp_path / 'pkg' / '__init__.py').write_text('')
+    (tmp_path / 'pkg' / 'mod.py').write_text('from .util import helper\n\ndef main(x):\n    y = helper(x)\n    return y\n')
+    (tmp_path / 'pkg' / 'util.py').write_text('def helper(x):\n    return x\n')
+    project = daemon.Project(str(tmp_path))
+    assert len(project.scan()) == 3
+    return project
+
+
+def test_queries(project):
+    assert project.handle({'op': 'functions', 'module': 'pkg.mod'}) == ['main']
+    assert project.handle({'op': 'functions', 'file': 'pkg/util.py'}) == ['helper']
+    calls = project.handle({'op': 'calls', 'module': 'pkg.mod', 'function': 'main'})
+    assert [(call['name'], call['callee']) for call in calls] == [('helper', 'pkg.util.helper')]
+    [(name, metrics)] = project.handle({'op': 'metrics', 'module': 'pkg.mod', 'function': 'main'})
+    assert name == 'pkg.mod.main' and metrics['calls'] == 1
+    with pytest.raises(LookupError):
+        project.handle({'op': 'functions', 'module': 'pkg.missing'})
+    with pytest.raises(ValueError):
+        project.handle({'op': 'nothing'})
+
+
+def test_scan_rebuilds_changed_files(project, tmp_path):
+    project.handle({'op': 'functions', 'module': 'pkg.util'})
+    (tmp_path / 'pkg' / 'util.py').write_text('def helper(x):\n    return x\n\ndef other():\n    pass\n')
+    assert project.scan() == [str(tmp_path / 'pkg' / 'util.py')]
+    assert project.rebuilds == 1
+    assert project.handle({'op': 'functions', 'module': 'pkg.util'}) == ['helper', 'other']
+    (tmp_path / 'pkg' / 'util.py').unlink()
+    project.scan()
+    with pytest.raises(LookupError):
+        project.handle({'op': 'functions', 'module': 'pkg.util'})
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='needs Unix sockets')
+def test_server(project, tmp_path):
+    path = str(tmp_path / 'daemon.sock')
+    server = daemon.Server(path, project)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        assert daemon.query(path, {'op': 'ping'})['root'] == project.root
+        assert daemon.query(path, {'op': 'functions', 'module': 'pkg.mod'}) == ['main']
+        with pytest.raises(RuntimeError, match='LookupError'):
+            daemon.query(path, {'op': 'cfg', 'module': 'pkg.mod', 'function': 'missing'})
+        daemon.query(path, {'op': 'shutdown'})
+        thread.join(5)
+        assert not thread.is_alive()
+    finally:
+        server.server_close()
@@ -0,0 +1,43 @@
+from cfg import build_from_source
+
+SOURCE = '''\
+def f(x):
+    if x:
+        a()
+    else:
+        b()
+    c()
+    while x:
+        x -= 1
+    return x
+'''
+
+
+def reached(successors, root, removed):
+    seen, stack = {root}, [root]
+    while stack:
+        for bid in successors[stack.pop()]:
+            if bid != removed and bid not in seen:
+                seen.add(bid)
+                stack.append(bid)
+    return seen
+
+
+def test_dominators():
+    f = build_from_source(SOURCE, 'mod').func_calls['f']
+    assert f.immediate_dominators() == {1: 1, 2: 1, 3: 1, 4: 1, 5: 2, 6: 5, 7: 5}
+    assert f.immediate_dominators(post=True) == {0: 0, 1: 2, 2: 5, 3: 2, 4: 2, 5: 6, 6: 0, 7: 5}
+    assert f.dominance_frontier(3) == {2}
+    assert f.dominance_frontier(7) == {5}
+    assert f.dominance_frontier(3, post=True) == {1}
+
+
+def test_dominates_agrees_with_reachability():
+    # a dominates b if and only if b cannot be reached from the root without passing a
+    f = build_from_source(SOURCE, 'mod').func_calls['f']
+    for post in (False, True):
+        root, successors, _ = f.flow(post)
+        for a in successors:
+            unreached = set(successors) - reached(successors, root, a) if a != root else set(successors)
+            for b in successors:
+                assert f.dominates(a, b, post) == (b in unreached or a == b), (a, b, post)
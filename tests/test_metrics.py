@@ -0,0 +1,65 @@
+from cfg import build_from_source
+
+SOURCE = '''\
+def straight(x):
+    return x + 1
+
+def branch(x):
+    if x:
+        return 1
+    return 0
+
+def guarded(x):
+    try:
+        a(x)
+    except ValueError:
+        b()
+    except KeyError:
+        c()
+    finally:
+        d()
+    return x
+
+def nested(xs):
+    for x in xs:
+        while x:
+            try:
+                x = f(x)
+            except ValueError:
+                continue
+    return xs
+'''
+
+
+def metrics(name):
+    return build_from_source(SOURCE, 'metrics').func_calls[name].metrics()
+
+
+def test_cyclomatic():
+    assert metrics('straight')['cyclomatic'] == 1
+    assert metrics('branch')['cyclomatic'] == 2
+
+
+def test_try_handlers_are_not_loops():
+    values = metrics('guarded')
+    assert (values['loops'], values['max_loop_depth']) == (0, 0)
+    assert values['calls'] == 4
+    assert values['exception_edges'] == 2
+
+
+def test_nested_loops():
+    values = metrics('nested')
+    assert (values['loops'], values['max_loop_depth']) == (2, 2)
+
+
+def test_function_metrics_names():
+    cfg = build_from_source(SOURCE, 'metrics')
+    assert [name for name, _ in cfg.function_metrics()] == ['metrics', 'metrics.straight', 'metrics.branch',
+                                                          'metrics.guarded', 'metrics.nested']
+
+
+def test_loops_survive_coalesce():
+    cfg = build_from_source('a = [x for y in z if y for x in y if x]\n', 'comps')
+    before = cfg.metrics()['loops'], cfg.metrics()['max_loop_depth']
+    cfg.coalesce()
+    assert (cfg.metrics()['loops'], cfg.metrics()['max_loop_depth']) == before == (2, 2)
@@ -0,0 +1,41 @@
+import ast, glob, multiprocessing, os
+
+import pytest
+
+from cfg import build_from_source
+
+EXAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples', '*.py')))
+
+SOURCE = '\n'.join('''\
+def f{0}(xs):
+    total = 0
+    for x in xs:
+        if x > {0}:
+            total += g(x)
+    def inner(y):
+        try:
+            return y / {0}
+        except ZeroDivisionError:
+            return 0
+    return [inner(x) for x in xs]
+'''.format(i) for i in range(8))
+
+pytestmark = pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+
+
+def test_parallel_build_equals_sequential():
+    sources = [SOURCE]
+    for path in EXAMPLES:
+        with open(path) as f:
+            sources.append(f.read())
+    for source in sources:
+        assert build_from_source(source, 'mod', jobs=3).to_dict() == build_from_source(source, 'mod').to_dict()
+
+
+def test_parallel_build_keeps_the_module_tree():
+    # statements are mapped back to the nodes of the tree in this process, not unpickled copies
+    cfg = build_from_source(SOURCE, 'mod', jobs=3)
+    assert all(cfg.func_calls.is_built('f{}'.format(i)) for i in range(8))
+    f = cfg.func_calls['f3']
+    nodes = {id(node) for node in ast.walk(cfg.func_calls.trees['f3'])}
+    assert all(id(stmt) in nodes for block in f.blocks.values() for stmt in block.stmts if hasattr(stmt, 'lineno'))
@@ -0,0 +1,67 @@
+from cfg import build_from_source, rebuild_from_source
+
+OLD = '''\
+def unchanged(x):
+    for i in x:
+        print(i)
+
+def changed(x):
+    return x + 1
+
+def outer():
+    def inner():
+        return 1
+    return inner
+'''
+
+NEW = '''\
+import sys
+
+def unchanged(x):
+    for i in x:
+        print(i)
+
+def changed(x):
+    return x + 2
+
+def added():
+    pass
+
+def outer():
+    def inner():
+        return 1
+    return inner
+'''
+
+
+def built(cfg):
+    # the old CFG with every function CFG built, as rebuild_from_source only reuses built ones
+    pending = [cfg]
+    while pending:
+        curr = pending.pop()
+        pending.extend(curr.func_calls.values())
+    return cfg
+
+
+def test_rebuild_equals_fresh_build():
+    result = rebuild_from_source(built(build_from_source(OLD, 'mod')), NEW)
+    assert result.cfg.to_dict() == build_from_source(NEW, 'mod').to_dict()
+
+
+def test_rebuild_reuses_unchanged_functions():
+    old = built(build_from_source(OLD, 'mod'))
+    graph = old.func_calls['unchanged']
+    result = rebuild_from_source(old, NEW)
+    assert sorted(result.reused) == ['outer', 'unchanged']
+    assert sorted(result.rebuilt) == ['added', 'changed']
+    assert result.cfg.func_calls['unchanged'] is graph
+    # line numbers follow the new source
+    assert result.cfg.func_calls['unchanged'].to_dict()['blocks'][0]['stmts'][0] == [4, 4]
+
+
+def test_rebuild_keeps_unbuilt_functions_lazy():
+    result = rebuild_from_source(build_from_source(OLD, 'mod'), NEW)
+    assert result.reused == []
+    assert result.rebuilt == ['added']
+    assert not result.cfg.func_calls.is_built('unchanged')
+    assert result.cfg.to_dict() == build_from_source(NEW, 'mod').to_dict()
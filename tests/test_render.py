@@ -0,0 +1,59 @@
+import os, stat, sys
+
+import pytest
+
+import render
+from cfg import build_from_source
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='fake graphviz is a shell script')
+
+# stands in for dot: copies its input to the -o file, fails on BAD and hangs on SLOW
+FAKE_DOT = '''\
+#!/bin/sh
+src=$(cat)
+case "$src" in *SLOW*) sleep 30;; esac
+case "$src" in *BAD*) echo "syntax error" >&2; exit 1;; esac
+printf '%s' "$src" > "$3"
+'''
+
+
+@pytest.fixture
+def engine(tmp_path):
+    path = tmp_path / 'fake-dot'
+    path.write_text(FAKE_DOT)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def test_render_all_reports_failures_per_graph(tmp_path, engine):
+    graphs = [('digraph { a }', str(tmp_path / 'ok')), ('digraph { BAD }', str(tmp_path / 'bad')),
+              ('digraph { SLOW }', str(tmp_path / 'slow'))]
+    for results in [render.render_all(graphs, jobs=2, timeout=0.5, fmt='svg', engine=engine),
+                    render.Renderer(2, 0.5, 'svg', engine).render_threaded(graphs)]:
+        ok, bad, slow = results
+        assert ok.error is None and ok.output == str(tmp_path / 'ok.svg')
+        with open(ok.output) as f:
+            assert f.read() == 'digraph { a }'
+        assert bad.output is None and 'syntax error' in bad.error
+        assert slow.output is None and 'timed out' in slow.error
+
+
+def test_render_cfg(tmp_path, engine):
+    cfg = build_from_source('def f(x):\n    return g(x)\n', 'mod')
+    output = render.Renderer(fmt='svg', engine=engine).render_sync(cfg, str(tmp_path / 'mod'))
+    with open(output) as f:
+        assert 'cluster_f' in f.read()
+
+
+def test_render_sharded(tmp_path, engine):
+    source = 'def f(x):\n    def inner():\n        pass\n    return x\n\ndef broken():\n    break\n\nlambda_ = lambda: 0\n'
+    results = render.render_sharded(build_from_source(source, 'mod'), str(tmp_path / 'out'), 'svg', engine=engine)
+    assert [os.path.basename(result.filepath) for result in results] == ['_module_', 'f', 'f.inner', 'broken', 'lambda_']
+    assert [result.error is None for result in results] == [True, True, True, False, True]
+    # every shard leaves out the functions nested in it
+    with open(results[1].output) as f:
+        assert 'cluster_f.inner' not in f.read()
+    with open(tmp_path / 'out' / 'index.html') as f:
+        index = f.read()
+    assert '<a href="f.inner.svg">inner</a>' in index
+    assert 'broken: AssertionError' in index
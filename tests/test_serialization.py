@@ -0,0 +1,73 @@
+import glob, os
+
+import pytest
+
+from cfg import CFG, build_from_source
+
+EXAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples', '*.py')))
+
+SOURCE = '''\
+import os
+
+def outer(xs):
+    total = 0
+    for x in xs:
+        if x > 0:
+            total += x
+        else:
+            break
+    else:
+        total = -1
+    def inner(y):
+        try:
+            return y / 2
+        except ZeroDivisionError:
+            return 0
+        finally:
+            print('done')
+    squares = [inner(x) ** 2 for x in xs if x]
+    return total, squares
+
+f = lambda v: v + 1
+'''
+
+
+@pytest.mark.parametrize('path', EXAMPLES, ids=os.path.basename)
+def test_bytes_round_trip_examples(path):
+    with open(path) as f:
+        source = f.read()
+    cfg = build_from_source(source, path)
+    data = cfg.to_dict()
+    assert CFG.from_bytes(cfg.to_bytes(), source).to_dict() == data
+    assert CFG.from_json(cfg.to_json(), source).to_dict() == data
+
+
+def test_bytes_round_trip_nested_functions():
+    cfg = build_from_source(SOURCE, 'mod')
+    loaded = CFG.from_bytes(cfg.to_bytes(), SOURCE)
+    assert loaded.to_dict() == cfg.to_dict()
+    assert list(loaded.func_calls) == ['outer', 'f']
+    assert list(loaded.func_calls['outer'].func_calls) == ['inner']
+
+
+def test_bytes_without_source_keep_line_ranges():
+    cfg = build_from_source(SOURCE, 'mod')
+    loaded = CFG.from_bytes(cfg.to_bytes())
+    expected = cfg.to_dict()
+    assert loaded.to_dict()['edges'] == expected['edges']
+    assert [block['id'] for block in loaded.to_dict()['blocks']] == [block['id'] for block in expected['blocks']]
+    assert [block['calls'] for block in loaded.to_dict()['blocks']] == [block['calls'] for block in expected['blocks']]
+
+
+def test_unresolved_calls_round_trip():
+    source = "def f(xs):\n    ''.join(xs)\n    g('')\n"
+    cfg = build_from_source(source, 'mod')
+    assert cfg.func_calls['f'].start.calls == [None, 'g']
+    from_bytes = CFG.from_bytes(cfg.to_bytes(), source).to_dict()
+    assert from_bytes == CFG.from_json(cfg.to_json(), source).to_dict() == cfg.to_dict()
+    assert from_bytes['func_calls']['f']['blocks'][0]['calls'] == [None, 'g']
+
+
+def test_from_bytes_rejects_other_data():
+    with pytest.raises(ValueError):
+        CFG.from_bytes(b'not a cfg')